@@ -2,34 +2,242 @@
 Utilities for converting to and from Midi data and encoded/tokenized data.
 """
 
+import struct
 from collections import defaultdict
 
+import numpy as np
 import mido
+from mido.midifiles.meta import build_meta_message
+from mido.midifiles.midifiles import MAX_MESSAGE_LENGTH
 
 from anticipation.config import *
 from anticipation.vocab import *
 from anticipation.ops import unpad
 
+# message types of interest (status bytes without the channel)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+OTHER = 0xF0
+
+DEFAULT_TEMPO = 500000 # microseconds per beat
+
+# message types that midi_to_* don't model (reported as unhandled otherwise)
+IGNORED_MESSAGES = {
+    'set_tempo', 'time_signature', # we use real time
+    'aftertouch', 'polytouch', 'pitchwheel', 'sequencer_specific', # we don't attempt to model these
+    'control_change', # this includes pedal and per-track volume: ignore for now
+    'track_name', 'text', 'end_of_track', 'lyrics', 'key_signature', 'copyright', 'marker',
+    'instrument_name', 'cue_marker', 'device_name', 'sequence_number', # possibly useful metadata
+    'channel_prefix', # relatively common, but can we ignore this?
+    'midi_port', 'smpte_offset', 'sysex' # I have no idea what this is
+}
+
+
+class MidiParseError(ValueError):
+    """ the native parser doesn't handle a file: fall back on mido """
+
+
+def _read_varint(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+
+def _read_track(data, pos, end):
+    """ parse the messages of a track chunk: returns columns (tick, type, channel, data1, data2) """
+    ticks, types, channels, data1, data2 = [], [], [], [], []
+
+    tick = 0
+    last_status = None
+    while pos < end:
+        delta, pos = _read_varint(data, pos)
+        tick += delta
+
+        status = data[pos]
+        pos += 1
+        if status < 0x80:
+            # running status: this is the first data byte
+            if last_status is None or last_status >= 0xF0:
+                raise MidiParseError('unsupported running status')
+            status = last_status
+            pos -= 1
+        elif status != 0xFF:
+            last_status = status
+
+        kind = status & 0xF0
+        if kind < 0xF0:
+            if kind == PROGRAM_CHANGE or kind == 0xD0: # one data byte
+                a, b = data[pos], 0
+                pos += 1
+            else:
+                a, b = data[pos], data[pos+1]
+                pos += 2
+
+            if a > 127 or b > 127:
+                raise MidiParseError('data byte must be in range 0..127')
+
+            ticks.append(tick); types.append(kind); channels.append(status & 0x0F)
+            data1.append(a); data2.append(b)
+        elif status == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_varint(data, pos+1)
+            if length > MAX_MESSAGE_LENGTH:
+                raise MidiParseError('message too long')
+
+            payload = data[pos:pos+length]
+            pos += length
+            if meta_type == 0x2F: # end of track (dropped when tracks are merged)
+                continue
+
+            try:
+                message = build_meta_message(meta_type, list(payload))
+            except Exception as e:
+                raise MidiParseError('bad meta message') from e
+
+            # tempo changes are carried in data1
+            tempo = message.tempo if message.type == 'set_tempo' else -1
+            ticks.append(tick); types.append(OTHER); channels.append(0)
+            data1.append(tempo); data2.append(0)
+        elif status == 0xF0 or status == 0xF7:
+            length, pos = _read_varint(data, pos)
+            if length > MAX_MESSAGE_LENGTH:
+                raise MidiParseError('message too long')
+
+            payload = data[pos:pos+length]
+            pos += length
+            if payload[:1] == b'\xf0':
+                payload = payload[1:]
+            if payload[-1:] == b'\xf7':
+                payload = payload[:-1]
+            if any(byte > 127 for byte in payload):
+                raise MidiParseError('data byte must be in range 0..127')
+
+            ticks.append(tick); types.append(OTHER); channels.append(0)
+            data1.append(-1); data2.append(0)
+        else:
+            raise MidiParseError(f'unsupported status byte 0x{status:02x}')
+
+    if pos != end:
+        raise MidiParseError('message overruns the track')
+
+    return ticks, types, channels, data1, data2
+
+
+def parse_midi(data):
+    """
+    Parse the bytes of a standard MIDI file.
+
+    Returns the file's messages in playback order as arrays (type, channel,
+    data1, data2, delta): the type is NOTE_OFF, NOTE_ON, PROGRAM_CHANGE (with
+    the program in data1) or another status byte (OTHER for meta and system
+    messages), and delta is the time in seconds since the previous message.
+    Tracks are merged and times converted exactly as mido.MidiFile does, so
+    this matches iterating over the file with mido. Raises MidiParseError for
+    anything that the parser doesn't handle the same way as mido.
+    """
+    try:
+        if data[:4] != b'MThd':
+            raise MidiParseError('MThd not found')
+
+        size = struct.unpack('>L', data[4:8])[0]
+        fmt, num_tracks, ticks_per_beat = struct.unpack('>hhh', data[8:14])
+        if size < 6 or fmt == 2 or num_tracks < 0 or ticks_per_beat <= 0:
+            raise MidiParseError('unsupported header')
+
+        pos = 8 + size
+        columns = [[] for _ in range(5)]
+        for _ in range(num_tracks):
+            name, size = struct.unpack('>4sL', data[pos:pos+8])
+            if name != b'MTrk' or pos + 8 + size > len(data):
+                raise MidiParseError('bad track chunk')
+
+            for column, values in zip(columns, _read_track(data, pos+8, pos+8+size)):
+                column.extend(values)
+            pos += 8 + size
+    except (IndexError, struct.error) as e:
+        raise MidiParseError('truncated file') from e
+
+    ticks, types, channels, data1, data2 = (np.array(column, dtype=np.int64) for column in columns)
+
+    # merge the tracks: a stable sort by absolute time
+    order = np.argsort(ticks, kind='stable')
+    ticks, types, channels, data1, data2 = ticks[order], types[order], channels[order], data1[order], data2[order]
+
+    # the tempo of each message's delta is set by the latest preceding set_tempo
+    idx = np.where((types == OTHER) & (data1 >= 0), np.arange(len(ticks)), -1)
+    idx = np.concatenate([[-1], np.maximum.accumulate(idx)[:-1]]) if len(idx) else idx
+    tempo = np.where(idx >= 0, data1[np.maximum(idx, 0)], DEFAULT_TEMPO)
+
+    dticks = np.diff(ticks, prepend=0)
+    delta = np.where(dticks > 0, dticks * (tempo * 1e-6 / ticks_per_beat), 0.)
+
+    return types, channels, data1, data2, delta
+
+
+def midi_messages(midifile, debug=False):
+    """
+    The messages of a MIDI file (a filename or a mido.MidiFile), as returned by parse_midi.
+
+    Files are parsed natively when possible, falling back on mido.
+    """
+    if not isinstance(midifile, mido.MidiFile):
+        with open(midifile, 'rb') as f:
+            data = f.read()
+
+        try:
+            return parse_midi(data)
+        except MidiParseError:
+            if debug:
+                print('Falling back on mido: ', midifile)
+
+        midifile = mido.MidiFile(midifile)
+
+    columns = [[] for _ in range(5)]
+    for message in midifile:
+        # sanity check: negative time?
+        if message.time < 0:
+            raise ValueError
+
+        if message.type in ['note_on', 'note_off']:
+            kind = NOTE_ON if message.type == 'note_on' else NOTE_OFF
+            values = (kind, message.channel, message.note, message.velocity, message.time)
+        elif message.type == 'program_change':
+            values = (PROGRAM_CHANGE, message.channel, message.program, 0, message.time)
+        else:
+            if debug and message.type not in IGNORED_MESSAGES:
+                print('UNHANDLED MESSAGE', message.type, message)
+
+            values = (OTHER, 0, 0, 0, message.time)
+
+        for column, value in zip(columns, values):
+            column.append(value)
+
+    types, channels, data1, data2 = (np.array(column, dtype=np.int64) for column in columns[:4])
+    return types, channels, data1, data2, np.array(columns[4], dtype=np.float64)
+
 
 def midi_to_interarrival(midifile, debug=False, stats=False):
-    midi = mido.MidiFile(midifile)
+    types, channels, data1, data2, delta = midi_messages(midifile, debug=debug)
+
+    # only these messages affect the tokens
+    keep = (types == NOTE_ON) | (types == NOTE_OFF) | (types == PROGRAM_CHANGE) | (delta > 0)
 
     tokens = []
     dt = 0
 
     instruments = defaultdict(int) # default to code 0 = piano
-    tempo = 500000 # default tempo: 500000 microseconds per beat
     truncations = 0
-    for message in midi:
-        dt += message.time
+    for kind, channel, a, b, time in zip(*(column[keep].tolist() for column in (types, channels, data1, data2, delta))):
+        dt += time
 
-        # sanity check: negative time?
-        if message.time < 0:
-            raise ValueError
-
-        if message.type == 'program_change':
-            instruments[message.channel] = message.program
-        elif message.type in ['note_on', 'note_off']:
+        if kind == PROGRAM_CHANGE:
+            instruments[channel] = a
+        elif kind == NOTE_ON or kind == NOTE_OFF:
             delta_ticks = min(round(TIME_RESOLUTION*dt), MAX_INTERARRIVAL-1)
             if delta_ticks != round(TIME_RESOLUTION*dt):
                 truncations += 1
@@ -38,29 +246,10 @@ def midi_to_interarrival(midifile, debug=False, stats=False):
                 tokens.append(MIDI_TIME_OFFSET + delta_ticks) # add a time step event
 
             # special case: channel 9 is drums!
-            inst = 128 if message.channel == 9 else instruments[message.channel]
-            offset = MIDI_START_OFFSET if message.type == 'note_on' and message.velocity > 0 else MIDI_END_OFFSET
-            tokens.append(offset + (2**7)*inst + message.note)
+            inst = 128 if channel == 9 else instruments[channel]
+            offset = MIDI_START_OFFSET if kind == NOTE_ON and b > 0 else MIDI_END_OFFSET
+            tokens.append(offset + (2**7)*inst + a)
             dt = 0
-        elif message.type == 'set_tempo':
-            tempo = message.tempo
-        elif message.type == 'time_signature':
-            pass # we use real time
-        elif message.type in ['aftertouch', 'polytouch', 'pitchwheel', 'sequencer_specific']:
-            pass # we don't attempt to model these
-        elif message.type == 'control_change':
-            pass # this includes pedal and per-track volume: ignore for now
-        elif message.type in ['track_name', 'text', 'end_of_track', 'lyrics', 'key_signature',
-                              'copyright', 'marker', 'instrument_name', 'cue_marker',
-                              'device_name', 'sequence_number']:
-            pass # possibly useful metadata but ignore for now
-        elif message.type == 'channel_prefix':
-            pass # relatively common, but can we ignore this?
-        elif message.type in ['midi_port', 'smpte_offset', 'sysex']:
-            pass # I have no idea what this is
-        else:
-            if debug:
-                print('UNHANDLED MESSAGE', message.type, message)
 
     if stats:
         return tokens, truncations
@@ -126,73 +315,47 @@ def interarrival_to_midi(tokens, debug=False):
 
 
 def midi_to_compound(midifile, debug=False):
-    if type(midifile) == str:
-        midi = mido.MidiFile(midifile)
-    else:
-        midi = midifile
+    types, channels, data1, data2, delta = midi_messages(midifile, debug=debug)
+
+    # absolute time of each message
+    times = np.cumsum(delta)
+    keep = (types == NOTE_ON) | (types == NOTE_OFF) | (types == PROGRAM_CHANGE)
 
     tokens = []
     note_idx = 0
     open_notes = defaultdict(list)
 
-    time = 0
     instruments = defaultdict(int) # default to code 0 = piano
-    tempo = 500000 # default tempo: 500000 microseconds per beat
-    for message in midi:
-        time += message.time
-
-        # sanity check: negative time?
-        if message.time < 0:
-            raise ValueError
+    for kind, channel, a, b, time in zip(*(column[keep].tolist() for column in (types, channels, data1, data2, times))):
+        if kind == PROGRAM_CHANGE:
+            instruments[channel] = a
+            continue
 
-        if message.type == 'program_change':
-            instruments[message.channel] = message.program
-        elif message.type in ['note_on', 'note_off']:
-            # special case: channel 9 is drums!
-            instr = 128 if message.channel == 9 else instruments[message.channel]
+        # special case: channel 9 is drums!
+        instr = 128 if channel == 9 else instruments[channel]
 
-            if message.type == 'note_on' and message.velocity > 0: # onset
-                # time quantization
-                time_in_ticks = round(TIME_RESOLUTION*time)
+        if kind == NOTE_ON and b > 0: # onset
+            # time quantization
+            time_in_ticks = round(TIME_RESOLUTION*time)
 
-                # Our compound word is: (time, duration, note, instr, velocity)
-                tokens.append(time_in_ticks) # 5ms resolution
-                tokens.append(-1) # placeholder (we'll fill this in later)
-                tokens.append(message.note)
-                tokens.append(instr)
-                tokens.append(message.velocity)
+            # Our compound word is: (time, duration, note, instr, velocity)
+            tokens.append(time_in_ticks) # 5ms resolution
+            tokens.append(-1) # placeholder (we'll fill this in later)
+            tokens.append(a)
+            tokens.append(instr)
+            tokens.append(b)
 
-                open_notes[(instr,message.note,message.channel)].append((note_idx, time))
-                note_idx += 1
-            else: # offset
-                try:
-                    open_idx, onset_time = open_notes[(instr,message.note,message.channel)].pop(0)
-                except IndexError:
-                    if debug:
-                        print('WARNING: ignoring bad offset')
-                else:
-                    duration_ticks = round(TIME_RESOLUTION*(time-onset_time))
-                    tokens[5*open_idx + 1] = duration_ticks
-                    #del open_notes[(instr,message.note,message.channel)]
-        elif message.type == 'set_tempo':
-            tempo = message.tempo
-        elif message.type == 'time_signature':
-            pass # we use real time
-        elif message.type in ['aftertouch', 'polytouch', 'pitchwheel', 'sequencer_specific']:
-            pass # we don't attempt to model these
-        elif message.type == 'control_change':
-            pass # this includes pedal and per-track volume: ignore for now
-        elif message.type in ['track_name', 'text', 'end_of_track', 'lyrics', 'key_signature',
-                              'copyright', 'marker', 'instrument_name', 'cue_marker',
-                              'device_name', 'sequence_number']:
-            pass # possibly useful metadata but ignore for now
-        elif message.type == 'channel_prefix':
-            pass # relatively common, but can we ignore this?
-        elif message.type in ['midi_port', 'smpte_offset', 'sysex']:
-            pass # I have no idea what this is
-        else:
-            if debug:
-                print('UNHANDLED MESSAGE', message.type, message)
+            open_notes[(instr,a,channel)].append((note_idx, time))
+            note_idx += 1
+        else: # offset
+            try:
+                open_idx, onset_time = open_notes[(instr,a,channel)].pop(0)
+            except IndexError:
+                if debug:
+                    print('WARNING: ignoring bad offset')
+            else:
+                duration_ticks = round(TIME_RESOLUTION*(time-onset_time))
+                tokens[5*open_idx + 1] = duration_ticks
 
     unclosed_count = 0
     for _,v in open_notes.items():
@@ -0,0 +1,209 @@
+"""
+Reading and writing tokenized training sequences.
+
+Sequences are stored either as text (one sequence of space-separated tokens
+per line) or as binary shards: a fixed-size header followed by fixed-width
+records, so the position of sequence i is implied by the header.
+"""
+
+import shutil
+import struct
+from itertools import islice
+
+import numpy as np
+
+MAGIC = b'AMTOKENS'
+HEADER = struct.Struct('<8s8sQQ') # (magic, dtype, record length, record count)
+
+
+def write_header(f, dtype, length, count):
+    f.write(HEADER.pack(MAGIC, np.dtype(dtype).str.encode(), length, count))
+
+
+def read_header(f):
+    """ returns (dtype, record length, record count) of a binary shard """
+    magic, dtype, length, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('not a binary tokenized dataset')
+
+    return np.dtype(dtype.rstrip(b'\0').decode()), length, count
+
+
+def is_binary(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SequencePacker:
+    """
+    Packs a stream of tokens into fixed-length training sequences.
+
+    Tokens are consumed from a buffer through a cursor, and the buffer is only
+    compacted once all complete sequences have been taken from it. Each
+    sequence is passed through prepare (if given), which returns the sequence
+    to keep or None to drop it.
+    """
+
+    def __init__(self, length, prepare=None):
+        self.length = length
+        self.prepare = prepare
+
+        self.buffer = []
+        self.cursor = 0
+
+    def extend(self, tokens):
+        """ append tokens to the stream; returns the complete sequences """
+        sequences = []
+        self.buffer.extend(tokens)
+        while len(self.buffer) - self.cursor >= self.length:
+            seq = self.buffer[self.cursor:self.cursor+self.length]
+            self.cursor += self.length
+
+            if self.prepare:
+                seq = self.prepare(seq)
+
+            if seq is not None:
+                sequences.append(seq)
+
+        del self.buffer[:self.cursor]
+        self.cursor = 0
+
+        return sequences
+
+
+class SequenceWriter:
+    """
+    Packs a stream of tokens into fixed-length training sequences (see
+    SequencePacker) and writes them out.
+
+    Sequences are written in batches, either as lines of space-separated
+    tokens (text) or as fixed-width records of the given dtype (binary).
+    Every sequence in a binary shard must have the same length; the header
+    is completed when the writer is closed.
+    """
+
+    def __init__(self, output, length, binary=False, prepare=None, batch=1024, dtype=np.uint16):
+        self.file = open(output, 'wb' if binary else 'w')
+        self.packer = SequencePacker(length, prepare)
+        self.binary = binary
+        self.batch = batch
+        self.dtype = np.dtype(dtype)
+
+        self.pending = []
+        self.count = 0
+        self.width = None # record length of a binary shard
+
+        if self.binary:
+            write_header(self.file, self.dtype, 0, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def extend(self, tokens):
+        """ append tokens to the stream, writing out every complete sequence """
+        for seq in self.packer.extend(tokens):
+            self.write(seq)
+
+    def write(self, seq):
+        self.pending.append(seq)
+        self.count += 1
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        if self.binary:
+            records = np.array(self.pending, dtype=np.int64)
+            if self.width is None:
+                self.width = records.shape[1]
+            assert records.ndim == 2 and records.shape[1] == self.width
+
+            info = np.iinfo(self.dtype)
+            assert info.min <= records.min() and records.max() <= info.max
+            records.astype(self.dtype).tofile(self.file)
+        else:
+            self.file.write(''.join(' '.join(str(tok) for tok in seq) + '\n' for seq in self.pending))
+
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.binary:
+            self.file.seek(0)
+            write_header(self.file, self.dtype, self.width or 0, self.count)
+
+        self.file.close()
+
+
+class SequenceReader:
+    """
+    Random access to the sequences of a binary shard.
+
+    The records are memory-mapped, so opening a shard reads only its header
+    and indexing returns views into the file rather than copies.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.dtype, self.length, count = read_header(f)
+
+        if count == 0:
+            self.data = np.empty((0, self.length), dtype=self.dtype)
+        else:
+            self.data = np.memmap(filename, dtype=self.dtype, mode='r',
+                                  offset=HEADER.size, shape=(count, self.length))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return self.data[idx]
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+def read_sequences(filename, start=0, stop=None, step=1):
+    """ iterate over the sequences (as lists of tokens) of a text or binary dataset """
+    if is_binary(filename):
+        for seq in SequenceReader(filename)[start:stop:step]:
+            yield seq.tolist()
+    else:
+        with open(filename, 'r') as f:
+            for line in islice(f, start, stop, step):
+                yield [int(token) for token in line.split()]
+
+
+def text_to_binary(input, output, dtype=np.uint16):
+    """ convert a text dataset to a binary shard; returns the number of sequences """
+    with SequenceWriter(output, 0, binary=True, dtype=dtype) as writer:
+        for seq in read_sequences(input):
+            writer.write(seq)
+
+    return writer.count
+
+
+def concatenate(inputs, output, binary=False):
+    """ concatenate text or binary datasets, in order """
+    if not binary:
+        with open(output, 'wb') as f:
+            for filename in inputs:
+                with open(filename, 'rb') as part:
+                    shutil.copyfileobj(part, f)
+
+        return
+
+    shards = [SequenceReader(filename) for filename in inputs]
+    shards = [shard for shard in shards if len(shard) > 0]
+    dtype = shards[0].dtype if shards else np.dtype(np.uint16)
+    length = shards[0].length if shards else 0
+    with open(output, 'wb') as f:
+        write_header(f, dtype, length, sum(len(shard) for shard in shards))
+        for shard in shards:
+            assert shard.dtype == dtype and shard.length == length
+            shard.data.tofile(f)
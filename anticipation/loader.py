@@ -0,0 +1,148 @@
+"""
+PyTorch datasets for streaming training data.
+
+AugmentedDataset tokenizes and augments compound-encoded tracks on the fly,
+so augmented training sequences never need to be written to disk.
+TokenizedDataset streams sequences from pre-tokenized text or binary shards.
+Both shard their inputs across DataLoader workers and seed each worker
+deterministically from (seed, epoch, worker).
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.dataset import SequencePacker, SequenceReader, is_binary, read_sequences
+from anticipation.tokenize import M_ALT, maybe_tokenize, augment, prepare_sequence, random_state
+
+
+def worker_info():
+    """ returns (worker id, number of workers) of the current DataLoader worker """
+    info = get_worker_info()
+    if info is None:
+        return 0, 1
+
+    return info.id, info.num_workers
+
+
+class ShuffleBuffer:
+    """ approximate shuffling of a stream: yields a random element of a buffer of the given size """
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.buffer = []
+
+    def push(self, item):
+        """ add an item to the buffer; returns an evicted item once the buffer is full """
+        if self.size == 0:
+            return item
+
+        if len(self.buffer) < self.size:
+            self.buffer.append(item)
+            return None
+
+        idx = self.rng.integers(len(self.buffer))
+        item, self.buffer[idx] = self.buffer[idx], item
+        return item
+
+    def drain(self):
+        self.rng.shuffle(self.buffer)
+        items, self.buffer = self.buffer, []
+        return items
+
+
+class AugmentedDataset(IterableDataset):
+    """
+    Training sequences generated from compound-encoded tracks (*.compound.txt).
+
+    Each track goes through the same filtering, melody extraction, control
+    distortion, anticipation and windowing as tokenize, inside the loader
+    workers. Tracks are shuffled per epoch and windows are mixed through a
+    shuffle buffer, so the training split needs no external shuffle.
+    """
+
+    def __init__(self, datafiles, augment_factor=1, seed=0, shuffle=True, buffer_size=1024):
+        self.datafiles = list(datafiles)
+        self.augment_factor = augment_factor
+        self.seed = seed
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        datafiles = self.datafiles
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(datafiles))
+            datafiles = [datafiles[i] for i in order]
+
+        worker, workers = worker_info()
+        datafiles = datafiles[worker::workers]
+        rng, py_random, np_random = random_state([self.seed, self.epoch, worker])
+
+        instr = None
+        stats = 7*[0] # see tokenize
+        packer = SequencePacker(EVENT_SIZE*M_ALT,
+                lambda seq: prepare_sequence(seq, instr, stats, py_random=py_random))
+        buffer = ShuffleBuffer(self.buffer_size if self.shuffle else 0, rng)
+
+        for filename in datafiles:
+            with open(filename, 'r') as f:
+                all_events, _, status = maybe_tokenize([int(token) for token in f.read().split()])
+
+            if status > 0:
+                stats[status-1] += 1
+                continue
+
+            augmentations = augment(all_events, self.augment_factor, rng, py_random, np_random)
+            for instr, tokens, _ in augmentations:
+                for seq in packer.extend(tokens):
+                    seq = buffer.push(seq)
+                    if seq is not None:
+                        yield torch.tensor(seq)
+
+        for seq in buffer.drain():
+            yield torch.tensor(seq)
+
+
+class TokenizedDataset(IterableDataset):
+    """
+    Sequences from pre-tokenized datasets, in text or binary format.
+
+    Binary shards are memory-mapped and split across workers by sequence
+    index; text files are split across workers by file.
+    """
+
+    def __init__(self, filenames, seed=0, shuffle=False):
+        self.filenames = list(filenames)
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker, workers = worker_info()
+        rng = np.random.default_rng([self.seed, self.epoch, worker])
+
+        for i, filename in enumerate(self.filenames):
+            if is_binary(filename):
+                reader = SequenceReader(filename)
+                indices = np.arange(worker, len(reader), workers)
+                if self.shuffle:
+                    rng.shuffle(indices)
+
+                for idx in indices:
+                    yield torch.from_numpy(reader[idx].astype(np.int64))
+            else:
+                if i % workers != worker:
+                    continue
+
+                for seq in read_sequences(filename):
+                    yield torch.tensor(seq)
@@ -0,0 +1,84 @@
+"""
+Content-addressed manifests for incremental dataset builds.
+
+Each output of a build stage is recorded with a key: a hash of the stage's
+inputs (file contents and parameters) and of the config constants that the
+stage depends on. An output whose recorded key matches is up to date, so it
+can be skipped; changing a constant only invalidates the stages that use it.
+"""
+
+import hashlib
+import json
+import os
+
+from anticipation import config
+
+# the config constants that determine the output of each stage
+STAGE_CONSTANTS = {
+    # midi -> compound (convert.midi_to_compound)
+    'preprocess' : ['TIME_RESOLUTION'],
+    # compound -> augmented token streams (tokenize.augment_shard)
+    'augment' : ['DELTA', 'TIME_RESOLUTION', 'MAX_DURATION_IN_SECONDS', 'MAX_INTERARRIVAL_IN_SECONDS',
+                 'MAX_PITCH', 'MAX_INSTR', 'COMPOUND_SIZE', 'MAX_TRACK_INSTR',
+                 'MAX_TRACK_TIME_IN_SECONDS', 'MIN_TRACK_TIME_IN_SECONDS', 'MIN_TRACK_EVENTS'],
+    # token streams -> training sequences (tokenize.pack_shard)
+    'pack' : ['CONTEXT_SIZE', 'TIME_RESOLUTION', 'MAX_TIME_IN_SECONDS'],
+}
+
+
+def file_hash(filename, blocksize=2**20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def stage_key(stage, *inputs):
+    """ hash of a stage's inputs (JSON-serializable) together with its config constants """
+    constants = {name : getattr(config, name) for name in STAGE_CONSTANTS[stage]}
+    content = json.dumps([stage, constants, inputs], sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class Manifest:
+    """
+    Records (key, result) for each output of a build, persisted as JSON.
+
+    Saves are atomic (write then rename), so a manifest that survives a crash
+    only lists outputs that were completed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, output):
+        return output in self.entries
+
+    def key(self, output):
+        """ the recorded key of an output, or None """
+        entry = self.entries.get(output)
+        return entry['key'] if entry else None
+
+    def get(self, output, key):
+        """ the recorded result of an output if it is up to date, otherwise None """
+        entry = self.entries.get(output)
+        if entry is None or entry['key'] != key:
+            return None
+
+        return entry['result']
+
+    def put(self, output, key, result):
+        self.entries[output] = {'key' : key, 'result' : result}
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+
+        os.replace(tmp, self.filename)
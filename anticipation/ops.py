@@ -2,7 +2,9 @@
 Utilities for operating on encoded Midi sequences.
 """
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from operator import le
 
 from anticipation.config import *
 from anticipation.vocab import *
@@ -104,6 +106,11 @@ def sort(tokens):
     return sorted_tokens
 
 
+def is_sorted(tokens):
+    """ whether a sequence is in order of time """
+    return all(map(le, tokens[0:-3:3], tokens[3::3]))
+
+
 def split(tokens):
     """ split a sequence into events and controls """
 
@@ -165,23 +172,21 @@ def anticipate(events, controls, delta=DELTA*TIME_RESOLUTION):
       controls : unconsumed controls (control time > max_time(events) + delta)
     """
 
-    '''if len(controls) == 0:
-        return events, controls'''
-
     tokens = []
     event_time = 0
-    control_time = controls[0] - ATIME_OFFSET
+    consumed = 0 # controls[:consumed] have been interleaved
+    control_time = controls[0] - ATIME_OFFSET if len(controls) > 0 else float('inf')
     for time, dur, note in zip(events[0::3],events[1::3],events[2::3]):
         while event_time >= control_time - delta:
-            tokens.extend(controls[0:3])
-            controls = controls[3:] # consume this control
-            control_time = controls[0] - ATIME_OFFSET if len(controls) > 0 else float('inf')
+            tokens.extend(controls[consumed:consumed+3])
+            consumed += 3 # consume this control
+            control_time = controls[consumed] - ATIME_OFFSET if len(controls) > consumed else float('inf')
 
         assert note < CONTROL_OFFSET
         event_time = time - TIME_OFFSET
         tokens.extend([time, dur, note])
 
-    return tokens, controls
+    return tokens, controls[consumed:]
 
 
 def sparsity(tokens):
@@ -281,4 +286,26 @@ def translate(tokens, dt, seconds=False):
     return new_tokens
 
 def combine(events, controls):
-    return sort(events + [token - CONTROL_OFFSET for token in controls])
+    """ merge events with controls (converted to events) in order of time """
+    controls = [token - CONTROL_OFFSET for token in controls]
+    if not (is_sorted(events) and is_sorted(controls)):
+        return sort(events + controls)
+
+    # merge alternating runs of events and controls; events come first at equal times (as in sort)
+    event_times, control_times = events[0::3], controls[0::3]
+    tokens = []
+    i = j = 0
+    while j < len(control_times):
+        k = bisect_right(event_times, control_times[j], lo=i)
+        tokens.extend(events[3*i:3*k])
+        i = k
+        if i == len(event_times):
+            break
+
+        k = bisect_left(control_times, event_times[i], lo=j)
+        tokens.extend(controls[3*j:3*k])
+        j = k
+
+    tokens.extend(events[3*i:])
+    tokens.extend(controls[3*j:])
+    return tokens
@@ -0,0 +1,153 @@
+"""
+Fault-isolated parallel processing of dataset files.
+
+Each worker process handles one item at a time, so a pathological input
+can be stopped without losing the rest of the run: the runner kills a
+worker that exceeds its wall-clock limit, caps its address space, replaces
+it if it dies, and recycles workers periodically to bound memory growth.
+"""
+
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def _worker(func, conn, memory):
+    if memory and resource:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+
+        try:
+            conn.send(('ok', func(item)))
+        except MemoryError:
+            conn.send(('memory', f'exceeded the {memory} byte limit'))
+            break # the worker may be left in a bad state
+        except Exception:
+            conn.send(('error', traceback.format_exc().strip().splitlines()[-1]))
+
+    conn.close()
+
+
+class Worker:
+    def __init__(self, ctx, func, memory):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker, args=(func, child, memory), daemon=True)
+        self.process.start()
+        child.close()
+
+        self.item = None
+        self.start = None
+        self.tasks = 0
+
+    def submit(self, item):
+        self.item = item
+        self.start = time.monotonic()
+        self.conn.send(item)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def run_isolated(func, items, workers, timeout=None, memory=None, recycle=None):
+    """
+    Apply func to each item in separate worker processes.
+
+    Yields (item, status, value) in order of completion, where status is one of
+      'ok'      : value is the result of func(item)
+      'error'   : func raised an exception (value describes it)
+      'memory'  : func exceeded the memory limit (in bytes, of address space)
+      'timeout' : func ran for longer than timeout seconds and was killed
+      'killed'  : the worker died (value is its exit code; negative for a signal)
+
+    A worker is replaced after it fails and after it completes recycle items.
+    """
+    ctx = multiprocessing.get_context()
+    items = iter(items)
+    pool = []
+
+    def assign(worker):
+        """ give the worker its next item; returns False once the items are exhausted """
+        item = next(items, None)
+        if item is None:
+            worker.stop()
+            return False
+
+        worker.submit(item)
+        return True
+
+    try:
+        for _ in range(workers):
+            worker = Worker(ctx, func, memory)
+            if not assign(worker):
+                break
+
+            pool.append(worker)
+
+        while pool:
+            wakeup = None
+            if timeout:
+                wakeup = max(0, min(w.start + timeout for w in pool) - time.monotonic())
+
+            ready = wait([w.conn for w in pool] + [w.process.sentinel for w in pool], wakeup)
+
+            for worker in list(pool):
+                replace = False
+                if worker.conn in ready or worker.process.sentinel in ready:
+                    try:
+                        status, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        worker.process.join()
+                        status, value = 'killed', worker.process.exitcode
+
+                    worker.tasks += 1
+                    replace = status in ('memory', 'killed') \
+                            or (recycle is not None and worker.tasks >= recycle)
+                elif timeout and time.monotonic() - worker.start > timeout:
+                    status, value = 'timeout', f'exceeded {timeout} seconds'
+                    replace = True
+                else:
+                    continue
+
+                item = worker.item
+                if replace:
+                    if status in ('memory', 'killed', 'timeout'):
+                        worker.kill()
+                    else:
+                        worker.stop()
+
+                    pool.remove(worker)
+                    worker = Worker(ctx, func, memory)
+                    if assign(worker):
+                        pool.append(worker)
+                elif not assign(worker):
+                    pool.remove(worker)
+
+                yield item, status, value
+    finally:
+        for worker in pool:
+            worker.kill()
@@ -2,14 +2,22 @@
 API functions for sampling from anticipatory infilling models.
 """
 
+import copy
+import json
 import math
+import time
 
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 
 from tqdm import tqdm
 
 from anticipation import ops
+from anticipation.sequence import TokenSequence
 from anticipation.config import *
 from anticipation.vocab import *
 
@@ -52,6 +60,137 @@ def nucleus(logits, top_p):
     return logits
 
 
+class Nucleus:
+    """
+    Nucleus (top-p) sampling without sorting the full vocabulary.
+
+    The nucleus is found among the top-k candidates, doubling k until the
+    candidates cover top_p. The size of each nucleus is remembered (per key,
+    e.g. per token slot) to choose the initial k of the next search.
+    """
+
+    def __init__(self, k=64):
+        self.initial_k = k
+        self.k = {}
+
+    def search(self, probs, top_p, key=None):
+        """ the probabilities of the nucleus of a probability vector, and their indices """
+        candidates = int(torch.count_nonzero(probs))
+        k = min(self.k.get(key, self.initial_k), candidates)
+        while True:
+            top_probs, top_indices = torch.topk(probs, k)
+            cumulative_probs = torch.cumsum(top_probs, dim=-1)
+            if cumulative_probs[-1] > top_p or k == candidates:
+                break
+
+            k = min(2*k, candidates)
+
+        # keep tokens up to and including the first token above the threshold (as in nucleus)
+        excluded = cumulative_probs[:-1] > top_p
+        size = 1 + int(excluded.numel() - torch.count_nonzero(excluded))
+        self.k[key] = max(2*size, 8)
+
+        return top_probs[:size], top_indices[:size]
+
+    def sample(self, probs, top_p, key=None, profiler=None):
+        """ sample an index from the nucleus of a probability vector """
+        if top_p >= 1.0:
+            with timed(profiler, 'multinomial'):
+                return int(torch.multinomial(probs, 1))
+
+        with timed(profiler, 'nucleus'):
+            top_probs, top_indices = self.search(probs, top_p, key)
+
+        with timed(profiler, 'multinomial'):
+            return int(top_indices[torch.multinomial(top_probs, 1)])
+
+    def truncate(self, probs, top_p, key=None):
+        """ the (renormalized) distribution that sample draws from """
+        if top_p >= 1.0:
+            return probs
+
+        top_probs, top_indices = self.search(probs, top_p, key)
+        truncated = torch.zeros_like(probs)
+        truncated[top_indices] = top_probs/top_probs.sum()
+        return truncated
+
+
+class Profiler:
+    """
+    Per-event latency trace of sampling.
+
+    Each event records the time (in seconds) spent constructing input tensors,
+    in the model forward pass, applying the sampling constraints, searching
+    for the nucleus, and drawing the sample, along with the context length
+    and Markov window lookback. Pass a Profiler to generate (or add_token) to
+    collect a trace; events sampled speculatively are not recorded.
+    """
+
+    STAGES = ['tensor', 'forward', 'mask', 'nucleus', 'multinomial']
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events = []
+        self.current = None
+
+    def begin(self, **fields):
+        self.current = dict(event=len(self.events), **fields)
+        self.current.update({stage : 0.0 for stage in self.STAGES})
+        self.start = time.perf_counter()
+
+    def end(self):
+        self.current['total'] = time.perf_counter() - self.start
+        self.events.append(self.current)
+        self.current = None
+
+    @contextmanager
+    def time(self, stage):
+        if self.synchronize: torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        yield
+        if self.synchronize: torch.cuda.synchronize()
+        self.current[stage] += time.perf_counter() - t0
+
+    def write(self, filename):
+        """ write the trace as JSON lines, one per event """
+        with open(filename, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+
+    def summary(self, bins=10, width=40):
+        """ per-stage latency statistics and a histogram of per-event latency """
+        if not self.events:
+            return 'No events recorded'
+
+        lines = [f'{len(self.events)} events, mean context {sum(e["context"] for e in self.events)/len(self.events):.0f} tokens']
+        lines.append(f'{"stage":>12} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"share":>6}')
+        total = sum(e['total'] for e in self.events)
+        for stage in self.STAGES + ['total']:
+            values = sorted(e[stage] for e in self.events)
+            pct = lambda q: 1e3*values[min(int(q*len(values)), len(values)-1)]
+            lines.append(f'{stage:>12} {1e3*sum(values)/len(values):8.2f}ms {pct(.5):7.2f}ms'
+                         f' {pct(.9):7.2f}ms {pct(.99):7.2f}ms {100*sum(values)/total:5.1f}%')
+
+        values = [1e3*e['total'] for e in self.events]
+        lo, hi = min(values), max(values)
+        step = (hi - lo)/bins or 1
+        counts = [0]*bins
+        for v in values:
+            counts[min(int((v - lo)/step), bins-1)] += 1
+
+        lines.append('event latency histogram')
+        for j, count in enumerate(counts):
+            bar = '#'*round(width*count/max(counts))
+            lines.append(f'  {lo+j*step:8.2f}ms - {lo+(j+1)*step:8.2f}ms {count:6d} {bar}')
+
+        return '\n'.join(lines)
+
+
+def timed(profiler, stage):
+    """ time a stage of sampling if profiling """
+    return nullcontext() if profiler is None else profiler.time(stage)
+
+
 def future_logits(logits, curtime):
     """ don't sample events in the past """
     if curtime > 0:
@@ -73,7 +212,452 @@ def instr_logits(logits, full_history):
     return logits
 
 
-def add_token(model, z, tokens, top_p, current_time, debug=False):
+class Constraints:
+    """
+    Sampling constraints for a single generation.
+
+    The slot masks (time, duration, note) are computed once, and the set of
+    instruments in the history is maintained incrementally as tokens are
+    appended, so that each sampled token requires only a single masked fill.
+    """
+
+    def __init__(self, device='cpu'):
+        # mask[slot] is True for tokens that safe_logits excludes at that slot
+        self.slot_masks = torch.stack([safe_logits(torch.zeros(VOCAB_SIZE), slot).isinf()
+                                       for slot in range(3)]).to(device)
+        self.note_mask = self.slot_masks[2].clone()
+        self.time_mask = self.slot_masks[0].clone()
+
+        # contiguous vocabulary ranges legal at each slot, and their token ids
+        self.slot_ranges = [vocab_ranges(~mask) for mask in self.slot_masks.cpu()]
+        self.slot_vocab = [torch.cat([torch.arange(lo, hi) for lo, hi in ranges]).to(device)
+                           for ranges in self.slot_ranges]
+
+        self.instruments = defaultdict(int)
+        self.observed = 0
+
+    def observe(self, tokens):
+        """ update the instrument counts with tokens appended since the last call """
+        assert len(tokens) >= self.observed
+
+        changed = False
+        for note in tokens[self.observed+2::3]:
+            if note >= SPECIAL_OFFSET: continue
+
+            instr = (note - (NOTE_OFFSET if note < CONTROL_OFFSET else ANOTE_OFFSET))//2**7
+            changed |= instr not in self.instruments
+            self.instruments[instr] += 1
+
+        self.observed = len(tokens)
+        if changed and len(self.instruments) >= 16:
+            # don't sample more than 16 instruments
+            self.note_mask.copy_(self.slot_masks[2])
+            for instr in range(MAX_INSTR):
+                if instr not in self.instruments:
+                    self.note_mask[NOTE_OFFSET+instr*MAX_PITCH:NOTE_OFFSET+(instr+1)*MAX_PITCH] = True
+
+    def mask(self, idx, curtime):
+        """ the tokens excluded at position idx; curtime is relative to the history buffer """
+        if idx % 3 == 0:
+            # don't sample events in the past
+            self.time_mask.copy_(self.slot_masks[0])
+            if curtime > 0:
+                self.time_mask[TIME_OFFSET:TIME_OFFSET+curtime] = True
+
+            return self.time_mask
+        elif idx % 3 == 1:
+            return self.slot_masks[1]
+        else:
+            return self.note_mask
+
+    def discard(self, count):
+        """ account for count tokens dropped from the front of the observed history """
+        assert count <= self.observed
+        self.observed -= count
+
+    def apply(self, logits, idx, curtime):
+        return logits.masked_fill_(self.mask(idx, curtime), -float('inf'))
+
+    def slot_mask(self, idx, curtime):
+        """ the mask at position idx, restricted to the vocabulary legal at its slot """
+        mask = self.mask(idx, curtime)
+        return torch.cat([mask[lo:hi] for lo, hi in self.slot_ranges[idx % 3]])
+
+
+def vocab_ranges(allowed):
+    """ decompose a boolean vocabulary mask into contiguous (start, end) ranges """
+    ranges = []
+    for token in allowed.nonzero().flatten().tolist():
+        if ranges and ranges[-1][1] == token:
+            ranges[-1][1] = token+1
+        else:
+            ranges.append([token, token+1])
+
+    return [tuple(r) for r in ranges]
+
+
+def slot_logits(model, hidden, ranges):
+    """ evaluate the output embedding only over the given vocabulary ranges """
+    head = model.get_output_embeddings()
+    return torch.cat([F.linear(hidden, head.weight[lo:hi], None if head.bias is None else head.bias[lo:hi])
+                      for lo, hi in ranges], dim=-1)
+
+
+class PrefixCache:
+    """
+    Transformer key/value states after previously processed prompts.
+
+    States are keyed by the exact input tokens (including the global control
+    prefix z), so that repeated generations from the same prompt and controls
+    skip the forward pass over the prompt. The final output is either logits or
+    a hidden state (see forward), so each kind is cached separately. The least
+    recently used states are evicted once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict() # (hidden, tokens) -> (past, logits, nbytes)
+
+    def get(self, tokens, hidden=False):
+        """ a copy of the key/value state (and final logits or hidden state) after tokens, or None """
+        key = (hidden, tuple(tokens))
+        if key not in self.entries:
+            return None
+
+        self.entries.move_to_end(key)
+        past, logits, _ = self.entries[key]
+        return copy.deepcopy(past), logits.clone()
+
+    def put(self, tokens, past, logits, hidden=False):
+        key = (hidden, tuple(tokens))
+        if key in self.entries:
+            return
+
+        nbytes = past_nbytes(past) + logits.numel()*logits.element_size()
+        if nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = (copy.deepcopy(past), logits.clone(), nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+
+
+def past_nbytes(past):
+    """ memory held by a key/value state """
+    if isinstance(past, torch.Tensor):
+        return past.numel()*past.element_size()
+    elif isinstance(past, (tuple, list)):
+        return sum(past_nbytes(p) for p in past)
+    elif hasattr(past, 'layers'):
+        return sum(past_nbytes((layer.keys, layer.values)) for layer in past.layers)
+    elif hasattr(past, 'key_cache'):
+        return past_nbytes(past.key_cache) + past_nbytes(past.value_cache)
+
+    return 0
+
+
+class KVCache:
+    """ transformer key/value state for incremental decoding """
+
+    def __init__(self, prefixes=None):
+        self.prefixes = prefixes # an optional PrefixCache for the first (prompt) forward pass
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        self.tokens = torch.zeros(0, dtype=torch.long)
+
+    def crop(self, length):
+        """ discard the cached state beyond the first length tokens """
+        if length == 0:
+            self.reset()
+            return
+
+        if hasattr(self.past, 'crop'):
+            self.past.crop(length)
+        else:
+            # legacy format: a (key, value) pair of (batch, head, position, dim) tensors per layer
+            self.past = tuple(tuple(t[:,:,:length] for t in layer) for layer in self.past)
+
+        self.tokens = self.tokens[:length]
+
+
+def forward(model, input_tokens, cache=None, hidden=False, span=1, profiler=None):
+    """
+    Next-token logits for a token sequence, reusing cached key/value state if possible.
+
+    If hidden is set, skip the output embedding and return the final hidden state.
+    If span > 1, return the outputs at each of the final span positions.
+    """
+    net = model.base_model if hidden else model
+    with timed(profiler, 'tensor'):
+        input_tokens = torch.as_tensor(input_tokens, dtype=torch.long)
+
+    if cache is None:
+        with timed(profiler, 'tensor'):
+            input_tokens = input_tokens.unsqueeze(0).to(model.device)
+
+        with timed(profiler, 'forward'):
+            output = net(input_tokens)
+    else:
+        # keep the cached prefix shared with the input, re-priming the rest
+        # (e.g. when the Markov window slid or the history was re-relativized)
+        cached = min(len(cache.tokens), len(input_tokens))
+        mismatch = (cache.tokens[:cached] != input_tokens[:cached]).nonzero()
+        if len(mismatch) > 0:
+            cached = int(mismatch[0])
+
+        cached = min(cached, len(input_tokens) - span)
+        if cached < len(cache.tokens):
+            cache.crop(cached)
+
+        # look up the prompt in the prefix cache
+        prompt = cache.prefixes is not None and cached == 0 and span == 1
+        if prompt:
+            cache.prefixes, prefixes = None, cache.prefixes # only the first forward pass
+            prefix = prefixes.get(input_tokens.tolist(), hidden)
+            if prefix is not None:
+                cache.past, logits = prefix
+                cache.tokens = input_tokens.clone()
+                return logits
+
+        with timed(profiler, 'tensor'):
+            new_tokens = input_tokens[cached:].unsqueeze(0).to(model.device)
+
+        with timed(profiler, 'forward'):
+            output = net(new_tokens, past_key_values=cache.past, use_cache=True)
+
+        cache.past = output.past_key_values
+        cache.tokens = input_tokens.clone()
+
+    output = output.last_hidden_state if hidden else output.logits
+    if cache is not None and prompt:
+        prefixes.put(input_tokens.tolist(), cache.past, output[0,-1], hidden)
+
+    return output[0,-1] if span == 1 else output[0,-span:]
+
+
+def past_layers(past):
+    """ the (key, value) tensors of each layer of a key/value state """
+    if hasattr(past, 'layers'):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    elif hasattr(past, 'key_cache'):
+        return list(zip(past.key_cache, past.value_cache))
+
+    return [tuple(layer) for layer in past]
+
+
+def make_past(layers, like):
+    """ a key/value state of the same format as like, from the (key, value) tensors of each layer """
+    if isinstance(like, (tuple, list)):
+        return tuple(layers)
+
+    past = type(like)()
+    for j, (keys, values) in enumerate(layers):
+        past.update(keys, values, j)
+
+    return past
+
+
+class BatchKVCache:
+    """
+    Key/value state for a batch of sequences decoded in lockstep.
+
+    Each sequence (identified by an id) has a row of a shared padded state;
+    the attention mask marks the valid positions of each row. Rows can be
+    dropped, reordered and appended without recomputing the others, so
+    sequences can join and leave the batch (continuous batching).
+    """
+
+    def __init__(self, prefixes=None):
+        self.prefixes = prefixes # an optional PrefixCache for the first (prompt) forward pass
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        self.ids = ()
+        self.tokens = []       # the tokens cached in each row
+        self.mask = None       # (batch, width) attention mask over the cached positions
+        self.positions = None  # (batch,) the next position of each row
+
+    def select(self, rows):
+        """ keep only the given rows, in the given order """
+        rows = list(rows)
+        if rows == list(range(len(self.ids))):
+            return
+
+        if len(rows) == 0:
+            self.reset()
+            return
+
+        index = torch.tensor(rows, dtype=torch.long)
+        self.past = make_past([(keys[index.to(keys.device)], values[index.to(values.device)])
+                               for keys, values in past_layers(self.past)], self.past)
+        self.ids = tuple(self.ids[r] for r in rows)
+        self.tokens = [self.tokens[r] for r in rows]
+        self.mask = self.mask[index]
+        self.positions = self.positions[index]
+
+    def append(self, other):
+        """ append the rows of another cache, padding the narrower state on the left """
+        if other.past is None:
+            return
+
+        if self.past is None:
+            self.past, self.ids, self.tokens = other.past, other.ids, other.tokens
+            self.mask, self.positions = other.mask, other.positions
+            return
+
+        width = max(self.mask.shape[1], other.mask.shape[1])
+        pad = lambda t, dim: F.pad(t, (0,0)*(t.dim()-dim-1) + (width - t.shape[dim], 0))
+        self.past = make_past([(torch.cat([pad(k1, 2), pad(k2, 2)]), torch.cat([pad(v1, 2), pad(v2, 2)]))
+                               for (k1, v1), (k2, v2) in zip(past_layers(self.past), past_layers(other.past))],
+                              self.past)
+        self.ids = self.ids + other.ids
+        self.tokens = self.tokens + other.tokens
+        self.mask = torch.cat([pad(self.mask, 1), pad(other.mask, 1)])
+        self.positions = torch.cat([self.positions, other.positions])
+
+    def compact(self):
+        """ move the valid positions of each row to the end, dropping padding """
+        width = int(self.mask.sum(1).max())
+        index = torch.argsort(self.mask, dim=1, stable=True)[:,-width:] # padding first, then positions in order
+        layers = []
+        for keys, values in past_layers(self.past):
+            gather = index.to(keys.device)[:,None,:,None].expand(-1, keys.shape[1], -1, keys.shape[3])
+            layers.append((torch.gather(keys, 2, gather), torch.gather(values, 2, gather)))
+
+        self.past = make_past(layers, self.past)
+        self.mask = torch.gather(self.mask, 1, index)
+
+
+def extend_batch(model, inputs, cache, hidden=False):
+    """ run the model over the tokens of each input beyond those cached in its row """
+    chunks = [tokens[len(cached):] for tokens, cached in zip(inputs, cache.tokens)] if cache.past is not None else inputs
+    width = max(len(chunk) for chunk in chunks)
+    if cache.past is not None and cache.mask.shape[1] + width > CONTEXT_SIZE:
+        cache.compact()
+
+    # right-align each new chunk; padding is masked out of attention
+    input_tokens = torch.zeros(len(chunks), width, dtype=torch.long)
+    mask = torch.zeros(len(chunks), width, dtype=torch.long)
+    for j, chunk in enumerate(chunks):
+        input_tokens[j,width-len(chunk):] = torch.tensor(chunk)
+        mask[j,width-len(chunk):] = 1
+
+    positions = mask.cumsum(1) - 1
+    if cache.past is not None:
+        positions += cache.positions.unsqueeze(1)
+        mask = torch.cat([cache.mask, mask], dim=1)
+
+    output = model(input_tokens.to(model.device),
+                   attention_mask=mask.to(model.device),
+                   position_ids=positions.clamp(min=0).to(model.device),
+                   past_key_values=cache.past, use_cache=True)
+
+    cache.past = output.past_key_values
+    cache.tokens = inputs
+    cache.mask = mask
+    cache.positions = positions[:,-1] + 1
+
+    return (output.last_hidden_state if hidden else output.logits)[:,-1]
+
+
+def prime_batch(model, inputs, hidden=False, prefixes=None):
+    """
+    A cache primed with each of the inputs, and the output after each input.
+
+    Identical inputs (e.g., repeated samples from the same prompt) are only
+    evaluated once. If given, the PrefixCache prefixes supplies the state after
+    an input that has been evaluated before, and records the others.
+    """
+    primed = BatchKVCache()
+    unique = {tuple(tokens) : None for tokens in inputs}
+    if prefixes is None and len(unique) == len(inputs):
+        return primed, extend_batch(model, inputs, primed, hidden)
+
+    # the (past, output) of each distinct input, without padding
+    if prefixes is not None:
+        for tokens in unique:
+            unique[tokens] = prefixes.get(tokens, hidden)
+
+    missing = [tokens for tokens, state in unique.items() if state is None]
+    if missing:
+        batch = BatchKVCache()
+        outputs = extend_batch(model, [list(tokens) for tokens in missing], batch, hidden)
+        for j, tokens in enumerate(missing):
+            past = make_past([(keys[j:j+1,:,-len(tokens):], values[j:j+1,:,-len(tokens):])
+                              for keys, values in past_layers(batch.past)], batch.past)
+            unique[tokens] = (past, outputs[j])
+            if prefixes is not None:
+                prefixes.put(tokens, past, outputs[j], hidden)
+
+    for j, (tokens, (past, _)) in enumerate(unique.items()):
+        row = BatchKVCache()
+        row.past = past
+        row.ids = (j,) # the caller assigns the ids of the primed rows
+        row.tokens = [list(tokens)]
+        row.mask = torch.ones(1, len(tokens), dtype=torch.long)
+        row.positions = torch.tensor([len(tokens)])
+        primed.append(row)
+
+    # one row per input
+    rows = {tokens : j for j, tokens in enumerate(unique)}
+    primed.select(rows[tuple(tokens)] for tokens in inputs)
+    return primed, torch.stack([unique[tuple(tokens)][1] for tokens in inputs])
+
+
+def forward_batch(model, inputs, cache, ids, hidden=False):
+    """
+    Next-token logits (or final hidden states) for a batch of token sequences of different lengths.
+
+    A cached row whose tokens are a strict prefix of its sequence's input is
+    extended by the new tokens. Sequences without such a row (those that just
+    joined the batch, or whose Markov window slid) are primed separately, and
+    rows of sequences that left the batch are dropped; the other rows are not
+    recomputed.
+    """
+    net = model.base_model if hidden else model
+    ids = tuple(ids)
+    rows = {idx : j for j, idx in enumerate(cache.ids)}
+    keep, prime = [], []
+    for r, (idx, tokens) in enumerate(zip(ids, inputs)):
+        cached = cache.tokens[rows[idx]] if idx in rows else None
+        if cached is not None and len(cached) < len(tokens) and cached == tokens[:len(cached)]:
+            keep.append(r)
+        else:
+            prime.append(r)
+
+    # keep rows in their cached order, so that rows are only copied when the batch changes
+    keep.sort(key=lambda r: rows[ids[r]])
+    cache.select(rows[ids[r]] for r in keep)
+
+    outputs = []
+    if keep:
+        outputs.append(extend_batch(net, [inputs[r] for r in keep], cache, hidden))
+
+    if prime:
+        cache.prefixes, prefixes = None, cache.prefixes # only the first forward pass
+        primed, output = prime_batch(net, [inputs[r] for r in prime], hidden, prefixes)
+        outputs.append(output)
+        primed.ids = tuple(ids[r] for r in prime)
+        cache.append(primed)
+
+    order = keep + prime
+    cache.ids = tuple(ids[r] for r in order)
+
+    # outputs in the order of the batch
+    output = torch.cat(outputs)
+    inverse = torch.empty(len(order), dtype=torch.long)
+    inverse[torch.tensor(order)] = torch.arange(len(order))
+    return output[inverse.to(output.device)]
+
+
+def markov_window(z, tokens):
+    """ the (time-relativized) history visible to the model, and its time offset """
     assert len(tokens) % 3 == 0
 
     history = tokens.copy()
@@ -84,125 +668,597 @@ def add_token(model, z, tokens, top_p, current_time, debug=False):
     offset = ops.min_time(history, seconds=False)
     history[::3] = [tok - offset for tok in history[::3]] # relativize time in the history buffer
 
+    return history, offset
+
+
+class Context:
+    """
+    The Markov window of a generation, maintained incrementally.
+
+    Tokens are appended in place to a preallocated buffer and the window
+    slides by one event whenever it overflows the context. The buffer holds
+    two windows, so the window is copied back to the front of the buffer only
+    once per window of appends. The time offset of the window (its minimum
+    time) is tracked with a deque of candidate minima.
+    """
+
+    def __init__(self, z, tokens=()):
+        self.z = list(z)
+        self.size = 1024-3-len(z)
+        assert self.size % 3 == 0
+
+        self.buffer = torch.empty(2*self.size, dtype=torch.long)
+        self.start = self.end = 0 # the window is buffer[start:end]
+        self.length = 0           # tokens appended in total
+        self.minima = deque()     # (index, time) of possible window minima, in increasing time
+
+        # the (time-relativized) model input
+        self.input = torch.empty(len(z)+self.size+3, dtype=torch.long)
+        self.input[:len(z)] = torch.tensor(self.z, dtype=torch.long)
+        self.relative = False
+
+        self.extend(tokens)
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def lookback(self):
+        return self.length - len(self)
+
+    @property
+    def offset(self):
+        return self.minima[0][1] if self.minima else 0
+
+    def extend(self, tokens):
+        assert len(tokens) % 3 == 0
+        for j in range(0, len(tokens), 3):
+            self.append(tokens[j:j+3])
+
+    def append(self, token):
+        """ append an event (or control) to the window """
+        time, dur, note = token
+        time -= TIME_OFFSET if note < CONTROL_OFFSET else ATIME_OFFSET
+
+        if self.end == len(self.buffer):
+            self.buffer[:len(self)] = self.buffer[self.start:self.end].clone()
+            self.start, self.end = 0, len(self)
+
+        self.buffer[self.end:self.end+3] = torch.tensor(token, dtype=torch.long)
+        self.end += 3
+
+        while self.minima and self.minima[-1][1] >= time:
+            self.minima.pop()
+        self.minima.append((self.length, time))
+        self.length += 3
+
+        if len(self) > self.size:
+            self.start += 3
+            if self.minima[0][0] < self.lookback:
+                self.minima.popleft()
+
+        self.relative = False
+
+    def tokens(self, new_token=()):
+        """ the model input: z, then the window (relative to offset), then the partial new token """
+        n = len(self.z) + len(self)
+        if not self.relative:
+            window = self.input[len(self.z):n]
+            window.copy_(self.buffer[self.start:self.end])
+            window[::3] -= self.offset
+            self.relative = True
+
+        self.input[n:n+len(new_token)] = torch.tensor(new_token, dtype=torch.long)
+        return self.input[:n+len(new_token)]
+
+
+def add_token(model, z, tokens, top_p, current_time, debug=False, cache=None, constraints=None, slot_head=False, sampler=None, profiler=None, context=None):
+    """
+    Sample the next event of a sequence.
+
+    If given, context is the Markov window of the tokens (z and tokens are then
+    ignored for the model input); otherwise it is built from scratch.
+    """
+    if constraints is None:
+        constraints = Constraints(model.device)
+
+    if sampler is None:
+        sampler = Nucleus()
+
+    if context is None:
+        context = Context(z, tokens)
+
+    offset = context.offset
+    if profiler is not None:
+        profiler.begin(time=current_time, context=len(z)+len(context), lookback=context.lookback)
+
+    with timed(profiler, 'mask'):
+        constraints.observe(tokens)
+
     new_token = []
     with torch.no_grad():
         for i in range(3):
-            input_tokens = torch.tensor(z + history + new_token).unsqueeze(0).to(model.device)
-            output = model(input_tokens)
-
-            idx = input_tokens.shape[1]-1
-            logits = safe_logits(output.logits[0,-1], idx)
-            if i == 0:
-                logits = future_logits(logits, current_time - offset)
-            elif i == 2:
-                logits = instr_logits(logits, tokens)
-            logits = nucleus(logits, top_p)
+            input_tokens = context.tokens(new_token)
+            idx = len(input_tokens)-1
+            if slot_head:
+                # only evaluate the output embedding over the vocabulary legal at this slot
+                hidden = forward(model, input_tokens, cache, hidden=True, profiler=profiler)
+                with timed(profiler, 'forward'):
+                    logits = slot_logits(model, hidden, constraints.slot_ranges[idx % 3])
+                with timed(profiler, 'mask'):
+                    logits.masked_fill_(constraints.slot_mask(idx, current_time - offset), -float('inf'))
+            else:
+                logits = forward(model, input_tokens, cache, profiler=profiler)
+                with timed(profiler, 'mask'):
+                    logits = constraints.apply(logits, idx, current_time - offset)
 
-            probs = F.softmax(logits, dim=-1)
-            token = torch.multinomial(probs, 1)
+            with timed(profiler, 'nucleus'):
+                probs = F.softmax(logits, dim=-1)
+            token = sampler.sample(probs, top_p, idx % 3, profiler=profiler)
+            if slot_head:
+                token = constraints.slot_vocab[idx % 3][token]
 
             new_token.append(int(token))
 
     new_token[0] += offset # revert to full sequence timing
     if debug:
-        print(f'  OFFSET = {offset}, LEN = {len(history)}, TIME = {tokens[::3][-5:]}')
+        print(f'  OFFSET = {offset}, LEN = {len(context)}, TIME = {tokens[::3][-5:]}')
+
+    if profiler is not None:
+        profiler.end()
 
     return new_token
 
 
-def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, global_control=None):
-    if inputs is None:
-        inputs = []
+def add_token_batch(model, zs, token_lists, top_p, current_times, cache=None, ids=None, constraints=None, slot_head=False, sampler=None):
+    """ batched add_token: sample the next event for each of several sequences """
+    if not isinstance(top_p, (list, tuple)):
+        top_p = len(token_lists)*[top_p]
 
-    if controls is None:
-        controls = []
+    if cache is None:
+        cache = BatchKVCache()
 
-    start_time = int(TIME_RESOLUTION*start_time)
-    end_time = int(TIME_RESOLUTION*end_time)
+    if ids is None:
+        ids = range(len(token_lists))
 
-    # prompt is events up to start_time
-    prompt = ops.pad(ops.clip(inputs, 0, start_time, clip_duration=False), start_time)
+    if constraints is None:
+        constraints = [Constraints(model.device) for _ in token_lists]
 
-    # treat events beyond start_time as controls
-    future = ops.clip(inputs, start_time+1, ops.max_time(inputs, seconds=False), clip_duration=False)
-    if debug:
-        print('Future')
-        ops.print_tokens(future)
+    if sampler is None:
+        sampler = Nucleus()
 
-    # clip controls that preceed the sequence
-    controls = ops.clip(controls, DELTA, ops.max_time(controls, seconds=False), clip_duration=False)
+    for tokens, constraint in zip(token_lists, constraints):
+        constraint.observe(tokens)
 
-    if debug:
-        print('Controls')
-        ops.print_tokens(controls)
+    windows = [markov_window(z, tokens) for z, tokens in zip(zs, token_lists)]
 
-    if global_control:
-        z = global_control
-    else:
-        z = [ANTICIPATE] if len(controls) > 0 or len(future) > 0 else [AUTOREGRESS]
-        if debug:
-            if len(z) == 1:
-                print('AR Mode' if z[0] == AUTOREGRESS else 'AAR Mode')
+    new_tokens = [[] for _ in token_lists]
+    with torch.no_grad():
+        for i in range(3):
+            inputs = [z + history + new_token for z, (history, _), new_token in zip(zs, windows, new_tokens)]
+            slots = set((len(input_tokens)-1) % 3 for input_tokens in inputs)
+            if slot_head:
+                assert len(slots) == 1 # sequences must be aligned to restrict the vocabulary
+                slot = slots.pop()
+                hidden = forward_batch(model, inputs, cache, ids, hidden=True)
+                batch_logits = slot_logits(model, hidden, constraints[0].slot_ranges[slot])
+                masks = torch.stack([constraint.slot_mask(len(input_tokens)-1, current_time - offset)
+                    for input_tokens, constraint, current_time, (_, offset)
+                    in zip(inputs, constraints, current_times, windows)])
             else:
-                print('Melody control mode')
+                batch_logits = forward_batch(model, inputs, cache, ids)
+                masks = torch.stack([constraint.mask(len(input_tokens)-1, current_time - offset)
+                    for input_tokens, constraint, current_time, (_, offset)
+                    in zip(inputs, constraints, current_times, windows)])
+
+            batch_logits.masked_fill_(masks, -float('inf'))
+            batch_probs = F.softmax(batch_logits, dim=-1)
+            for new_token, input_tokens, probs, p in zip(new_tokens, inputs, batch_probs, top_p):
+                slot = (len(input_tokens)-1) % 3
+                token = sampler.sample(probs, p, slot)
+                if slot_head:
+                    token = constraints[0].slot_vocab[slot][token]
+
+                new_token.append(int(token))
+
+    for new_token, (_, offset) in zip(new_tokens, windows):
+        new_token[0] += offset # revert to full sequence timing
+
+    return new_tokens
+
+
+def speculate(model, draft_model, state, top_p, cache, draft_cache, constraints, sampler, draft_events=4):
+    """
+    Extend a generation by up to draft_events events with speculative sampling.
+
+    The draft model proposes events (interleaving anticipated controls as the
+    generation would) and the model scores every proposed token in a single
+    forward pass. Each proposed token is accepted with probability min(1, p/q);
+    the first rejected token is resampled from the residual max(p - q, 0) and
+    the rest of its event is sampled from the model. Committed events are thus
+    distributed exactly as under add_token.
+
+    Until the history fills the context, the proposals share its Markov window
+    and are scored as one sequence. After that, the window slides with every
+    event (as in add_token), so each proposal is scored in its own window and
+    the windows are evaluated together as a batch.
+    """
+    z = state.z
+    capacity = 1024-3-len(z)
+
+    draft = copy.copy(state)
+    draft.tokens = state.tokens.copy()
+    draft.controls = copy.copy(state.controls)
+    draft.context = copy.deepcopy(state.context)
+    draft.debug = False
+    draft_constraints = copy.deepcopy(constraints)
+
+    proposals = [] # (anticipated controls, event, window, time offset, masks, draft distributions)
+    sliding = None
+    with torch.no_grad():
+        while len(proposals) < draft_events and not draft.done:
+            committed = len(draft.tokens)
+            anticipated = draft.anticipate()
+            history, offset = markov_window(z, draft.tokens)
+            if proposals and (sliding != (len(draft.tokens) > capacity) or (not sliding and offset != proposals[0][3])):
+                # the model would see a different kind of window for this event
+                del draft.tokens[committed:]
+                break
 
-    # interleave the controls with the events
-    tokens, controls = ops.anticipate(prompt, ops.sort(controls + [CONTROL_OFFSET+token for token in future]))
+            sliding = len(draft.tokens) > capacity
+            draft_constraints.observe(draft.tokens)
+            current_time = max(draft.start_time, draft.current_time) - offset
+
+            event, masks, qs = [], [], []
+            for i in range(3):
+                input_tokens = z + history + event
+                idx = len(input_tokens)-1
+                mask = draft_constraints.mask(idx, current_time).clone()
+                logits = forward(draft_model, input_tokens, draft_cache).masked_fill(mask, -float('inf'))
+                q = sampler.truncate(F.softmax(logits, dim=-1), top_p, idx % 3)
+                event.append(int(torch.multinomial(q, 1)))
+                masks.append(mask)
+                qs.append(q)
+
+            event[0] += offset # revert to full sequence timing
+            proposals.append((anticipated, event, history, offset, masks, qs))
+            draft.append(event)
+
+    if not proposals:
+        state.anticipate()
+        new_token = add_token(model, z, state.tokens, top_p, max(state.start_time,state.current_time),
+                              cache=cache, constraints=constraints, sampler=sampler, context=state.context)
+        state.append(new_token)
+        return
+
+    # score all proposed tokens with the model
+    with torch.no_grad():
+        if sliding:
+            # every proposal has a full window of its own: evaluate the windows as a batch
+            inputs = torch.tensor([z + history + [event[0] - offset, event[1]]
+                                   for _, event, history, offset, _, _ in proposals], dtype=torch.long)
+            hidden = model.base_model(inputs.to(model.device)).last_hidden_state[:,-3:]
+            scores = model.get_output_embeddings()(hidden)
+        else:
+            offset = proposals[0][3]
+            proposed = [tok for anticipated, event, *_ in proposals for tok in anticipated + event]
+            sequence = state.tokens + proposed
+            sequence[::3] = [tok - offset for tok in sequence[::3]]
+            all_logits = forward(model, z + sequence[:-1], cache, span=len(proposed))
 
-    if debug:
-        print('Prompt')
-        ops.print_tokens(tokens)
+            scores, position = [], 0
+            for anticipated, *_ in proposals:
+                position += len(anticipated)
+                scores.append(all_logits[position:position+3])
+                position += 3
 
-    current_time = ops.max_time(prompt, seconds=False)
-    if debug:
-        print('Current time:', current_time)
+    for (anticipated, event, history, offset, masks, qs), event_logits in zip(proposals, scores):
+        assert state.anticipate() == anticipated
 
-    with tqdm(range(end_time-start_time)) as progress:
-        if controls:
-            atime, adur, anote = controls[0:3]
-            anticipated_tokens = controls[3:]
-            anticipated_time = atime - ATIME_OFFSET
-        else:
-            # nothing to anticipate
-            anticipated_time = MAX_TIME
+        for i in range(3):
+            logits = event_logits[i].masked_fill(masks[i], -float('inf'))
+            p = sampler.truncate(F.softmax(logits, dim=-1), top_p, (len(z)+len(history)+i-1) % 3)
+            q = qs[i]
+            token = event[i] - (offset if i == 0 else 0)
+            if torch.rand(1).item() < p[token]/q[token]:
+                continue
+
+            # rejected: resample from the residual distribution, then finish the event
+            residual = (p - q).clamp(min=0)
+            event = event[:i] + [int(torch.multinomial(residual/residual.sum(), 1))]
+            if i == 0:
+                event[0] += offset
 
-        while True:
-            while current_time >= anticipated_time - delta:
-                tokens.extend([atime, adur, anote])
-                if debug:
-                    note = anote - ANOTE_OFFSET
-                    instr = note//2**7
-                    print('A', atime - ATIME_OFFSET, adur - ADUR_OFFSET, instr, note - (2**7)*instr)
+            constraints.observe(state.tokens)
+            current_time = max(state.start_time, state.current_time) - offset
+            with torch.no_grad():
+                for j in range(i+1, 3):
+                    input_tokens = z + history + [event[0] - offset] + event[1:]
+                    idx = len(input_tokens)-1
+                    logits = constraints.apply(forward(model, input_tokens, cache), idx, current_time)
+                    event.append(sampler.sample(F.softmax(logits, dim=-1), top_p, idx % 3))
+
+            state.append(event)
+            return
 
-                if len(anticipated_tokens) > 0:
-                    atime, adur, anote = anticipated_tokens[0:3]
-                    anticipated_tokens = anticipated_tokens[3:]
-                    anticipated_time = atime - ATIME_OFFSET
+        if state.append(event) is None:
+            return
+
+
+class ControlQueue:
+    """
+    Controls awaiting interleaving into a sequence, in order of time.
+
+    The controls are held in an (n,3) array and consumed by advancing a
+    cursor, so consuming a control does not copy the remaining controls.
+    Copies of a queue share the array but advance independently.
+    """
+
+    def __init__(self, controls, time_offset=ATIME_OFFSET):
+        self.controls = np.array(controls, dtype=np.int64).reshape(-1, 3)
+        self.times = self.controls[:,0] - time_offset
+        assert np.all(self.times[1:] >= self.times[:-1])
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.controls) - self.cursor
+
+    def next_time(self):
+        """ the time of the next control (infinite if there are none) """
+        return int(self.times[self.cursor]) if len(self) > 0 else math.inf
+
+    def peek(self):
+        """ the next control """
+        return self.controls[self.cursor].tolist()
+
+    def pop(self, time):
+        """ consume the controls at or before time; returns their tokens """
+        end = self.cursor + int(np.searchsorted(self.times[self.cursor:], time, side='right'))
+        controls = self.controls[self.cursor:end].flatten().tolist()
+        self.cursor = end
+        return controls
+
+    def tolist(self):
+        """ the tokens of the remaining controls """
+        return self.controls[self.cursor:].flatten().tolist()
+
+
+class Generation:
+    """ decoding state of a single anticipatory sequence """
+
+    def __init__(self, start_time, end_time, inputs=None, controls=None, delta=DELTA*TIME_RESOLUTION, global_control=None, debug=False):
+        if inputs is None:
+            inputs = []
+
+        if controls is None:
+            controls = []
+
+        self.start_time = int(TIME_RESOLUTION*start_time)
+        self.end_time = int(TIME_RESOLUTION*end_time)
+        self.delta = delta
+        self.debug = debug
+
+        # prompt is events up to start_time
+        inputs = TokenSequence(inputs, index=True)
+        prompt = ops.pad(inputs.clip(0, self.start_time, clip_duration=False).tolist(), self.start_time)
+
+        # treat events beyond start_time as controls
+        self.future = inputs.clip(self.start_time+1, inputs.max_time(seconds=False), clip_duration=False).tolist()
+        if debug:
+            print('Future')
+            ops.print_tokens(self.future)
+
+        # clip controls that preceed the sequence
+        controls = ops.clip(controls, DELTA, ops.max_time(controls, seconds=False), clip_duration=False)
+
+        if debug:
+            print('Controls')
+            ops.print_tokens(controls)
+
+        if global_control:
+            self.z = global_control
+        else:
+            self.z = [ANTICIPATE] if len(controls) > 0 or len(self.future) > 0 else [AUTOREGRESS]
+            if debug:
+                if len(self.z) == 1:
+                    print('AR Mode' if self.z[0] == AUTOREGRESS else 'AAR Mode')
                 else:
-                    # nothing more to anticipate
-                    anticipated_time = MAX_TIME
+                    print('Melody control mode')
 
-            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time))
-            new_time = new_token[0] - TIME_OFFSET
-            if new_time >= end_time:
+        # interleave the controls with the events (e.g., an unconditional sample has none)
+        controls = ops.sort(controls + [CONTROL_OFFSET+token for token in self.future])
+        if len(controls) > 0:
+            self.tokens, controls = ops.anticipate(prompt, controls)
+        else:
+            self.tokens = list(prompt)
+        self.controls = ControlQueue(controls)
+
+        if debug:
+            print('Prompt')
+            ops.print_tokens(self.tokens)
+
+        self.current_time = ops.max_time(prompt, seconds=False)
+        if debug:
+            print('Current time:', self.current_time)
+
+        self.context = Context(self.z, self.tokens)
+        self.done = False
+
+    def anticipate(self):
+        """ append (and return) the controls that fall within the anticipation interval """
+        anticipated = self.controls.pop(self.current_time + self.delta)
+        if self.debug:
+            for atime, adur, anote in zip(anticipated[0::3], anticipated[1::3], anticipated[2::3]):
+                note = anote - ANOTE_OFFSET
+                instr = note//2**7
+                print('A', atime - ATIME_OFFSET, adur - ADUR_OFFSET, instr, note - (2**7)*instr)
+
+        self.tokens.extend(anticipated)
+        self.context.extend(anticipated)
+        return anticipated
+
+    def append(self, new_token):
+        """ append a sampled event and return the elapsed time (None once the sequence is complete) """
+        new_time = new_token[0] - TIME_OFFSET
+        if new_time >= self.end_time:
+            self.done = True
+            return None
+
+        if self.debug:
+            new_note = new_token[2] - NOTE_OFFSET
+            new_instr = new_note//2**7
+            new_pitch = new_note - (2**7)*new_instr
+            print('C', new_time, new_token[1] - DUR_OFFSET, new_instr, new_pitch)
+
+        self.tokens.extend(new_token)
+        self.context.append(new_token)
+        dt = new_time - self.current_time
+        assert dt >= 0
+        self.current_time = new_time
+        return dt
+
+    def trim(self, size):
+        """ discard all but the most recent size tokens of history; returns the number discarded """
+        discard = max(len(self.tokens) - size, 0)
+        discard -= discard % 3
+        del self.tokens[:discard]
+        return discard
+
+    def events(self):
+        events, _ = ops.split(self.tokens)
+        return ops.sort(ops.unpad(events) + self.future)
+
+
+def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, global_control=None, use_cache=True, slot_head=False, draft_model=None, draft_events=4, prefixes=None, profiler=None):
+    """
+    Generate an anticipatory sequence.
+
+    If a draft_model is given, events are sampled by speculative sampling (see
+    speculate), up to draft_events at a time. Once the history fills the
+    context, each proposed event is verified in its own Markov window, so the
+    model then evaluates a batch of full windows per step rather than the new
+    tokens alone: the speedup comes from fewer sequential forward passes.
+    """
+    state = Generation(start_time, end_time, inputs, controls, delta, global_control, debug)
+
+    cache = KVCache(prefixes) if use_cache else None
+    constraints = Constraints(model.device)
+    sampler = Nucleus()
+    if draft_model is not None:
+        # speculative sampling: the draft model proposes events for the model to verify
+        assert use_cache and not slot_head
+        draft_cache = KVCache()
+
+    with tqdm(range(state.end_time-state.start_time)) as progress:
+        while not state.done:
+            previous_time = state.current_time
+            if draft_model is None:
+                state.anticipate()
+                new_token = add_token(model, state.z, state.tokens, top_p, max(state.start_time,state.current_time),
+                                      cache=cache, constraints=constraints, slot_head=slot_head, sampler=sampler,
+                                      profiler=profiler, context=state.context)
+                state.append(new_token)
+            else:
+                speculate(model, draft_model, state, top_p, cache, draft_cache, constraints, sampler, draft_events)
+
+            progress.update(state.current_time - previous_time)
+
+    return state.events()
+
+
+def generate_stream(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, global_control=None, use_cache=True, slot_head=False, prefixes=None, profiler=None):
+    """
+    Generate an anticipatory sequence incrementally.
+
+    Yields each event as soon as it is sampled, and each anticipated control
+    (in the control vocabulary) as soon as it is interleaved into the sequence.
+    Only the Markov window of the history is retained, so memory use does not
+    grow with the length of the generation.
+    """
+    state = Generation(start_time, end_time, inputs, controls, delta, global_control, debug)
+
+    cache = KVCache(prefixes) if use_cache else None
+    constraints = Constraints(model.device)
+    sampler = Nucleus()
+    while True:
+        anticipated = state.anticipate()
+        for j in range(0, len(anticipated), 3):
+            yield anticipated[j:j+3]
+
+        new_token = add_token(model, state.z, state.tokens, top_p, max(state.start_time,state.current_time),
+                              cache=cache, constraints=constraints, slot_head=slot_head, sampler=sampler,
+                              profiler=profiler, context=state.context)
+        if state.append(new_token) is None:
+            break
+
+        # retain only the history visible to the model
+        constraints.discard(state.trim(1024-3-len(state.z)))
+
+        if new_token[2] != REST:
+            yield new_token
+
+
+def generate_batch(model, start_time, end_time, inputs_list=None, controls_list=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, global_control=None, slot_head=False, prefixes=None):
+    """
+    Generate several independent anticipatory sequences in lockstep.
+
+    Inputs and controls are given per sequence; start_time and end_time may be
+    either shared by all sequences or given per sequence. Each step samples one
+    event for every unfinished sequence with a single batched forward pass.
+
+    Sequences with the same prompt share its forward pass, and if given, the
+    PrefixCache prefixes reuses the prompt's state across calls.
+
+    Returns a list of generated event sequences, in the order of the inputs.
+    """
+    count = len(inputs_list) if inputs_list is not None else len(controls_list)
+    if inputs_list is None:
+        inputs_list = count*[None]
+
+    if controls_list is None:
+        controls_list = count*[None]
+
+    if not isinstance(start_time, (list, tuple)):
+        start_time = count*[start_time]
+
+    if not isinstance(end_time, (list, tuple)):
+        end_time = count*[end_time]
+
+    assert len(inputs_list) == len(controls_list) == len(start_time) == len(end_time) == count
+
+    states = [Generation(start, end, inputs, controls, delta, global_control, debug)
+              for start, end, inputs, controls in zip(start_time, end_time, inputs_list, controls_list)]
+
+    cache = BatchKVCache(prefixes)
+    constraints = [Constraints(model.device) for _ in states]
+    sampler = Nucleus()
+    with tqdm(range(sum(state.end_time-state.start_time for state in states))) as progress:
+        while True:
+            active = [j for j, state in enumerate(states) if not state.done]
+            if not active:
                 break
 
-            if debug:
-                new_note = new_token[2] - NOTE_OFFSET
-                new_instr = new_note//2**7
-                new_pitch = new_note - (2**7)*new_instr
-                print('C', new_time, new_token[1] - DUR_OFFSET, new_instr, new_pitch)
+            for j in active:
+                states[j].anticipate()
 
-            tokens.extend(new_token)
-            dt = new_time - current_time
-            assert dt >= 0
-            current_time = new_time
-            progress.update(dt)
+            new_tokens = add_token_batch(model,
+                    [states[j].z for j in active],
+                    [states[j].tokens for j in active],
+                    top_p,
+                    [max(states[j].start_time, states[j].current_time) for j in active],
+                    cache=cache, ids=active, constraints=[constraints[j] for j in active], slot_head=slot_head, sampler=sampler)
+
+            for j, new_token in zip(active, new_tokens):
+                dt = states[j].append(new_token)
+                if dt is None:
+                    # count the remaining interval of a completed sequence
+                    dt = states[j].end_time - states[j].current_time
+
+                progress.update(dt)
 
-    events, _ = ops.split(tokens)
-    return ops.sort(ops.unpad(events) + future)
+    return [state.events() for state in states]
 
-def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION):
+def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, use_cache=True, slot_head=False, prefixes=None, profiler=None):
     if inputs is None:
         inputs = []
 
@@ -238,17 +1294,16 @@ def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1
         print('Current time:', current_time)
 
     tokens = prompt
+    context = Context(z, tokens)
+    cache = KVCache(prefixes) if use_cache else None
+    constraints = Constraints(model.device)
+    sampler = Nucleus()
+    queue = ControlQueue(controls, time_offset=TIME_OFFSET)
     with tqdm(range(end_time-start_time)) as progress:
-        if controls:
-            atime, adur, anote = controls[0:3]
-            anticipated_tokens = controls[3:]
-            anticipated_time = atime - TIME_OFFSET
-        else:
-            # nothing to anticipate
-            anticipated_time = math.inf
-
         while True:
-            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time))
+            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time),
+                                  cache=cache, constraints=constraints, slot_head=slot_head, sampler=sampler,
+                                  profiler=profiler, context=context)
             new_time = new_token[0] - TIME_OFFSET
             if new_time >= end_time:
                 break
@@ -258,21 +1313,15 @@ def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1
             current_time = new_time
 
             # backfill anything that should have come before the new token
-            while current_time >= anticipated_time:
-                tokens.extend([atime, adur, anote])
-                if debug:
+            backfill = queue.pop(current_time)
+            tokens.extend(backfill)
+            context.extend(backfill)
+            if debug:
+                for atime, adur, anote in zip(backfill[0::3], backfill[1::3], backfill[2::3]):
                     note = anote - NOTE_OFFSET
                     instr = note//2**7
                     print('A', atime - TIME_OFFSET, adur - DUR_OFFSET, instr, note - (2**7)*instr)
 
-                if len(anticipated_tokens) > 0:
-                    atime, adur, anote = anticipated_tokens[0:3]
-                    anticipated_tokens = anticipated_tokens[3:]
-                    anticipated_time = atime - TIME_OFFSET
-                else:
-                    # nothing more to anticipate
-                    anticipated_time = math.inf
-
             if debug:
                 new_note = new_token[2] - NOTE_OFFSET
                 new_instr = new_note//2**7
@@ -280,9 +1329,10 @@ def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1
                 print('C', new_time, new_token[1] - DUR_OFFSET, new_instr, new_pitch)
 
             tokens.extend(new_token)
+            context.append(new_token)
             progress.update(dt)
 
-    if anticipated_time != math.inf:
-        tokens.extend([atime, adur, anote])
+    if queue:
+        tokens.extend(queue.peek())
 
     return ops.sort(ops.unpad(tokens) + controls)
@@ -0,0 +1,428 @@
+"""
+An array-backed token sequence with vectorized versions of the operations in ops.
+"""
+
+import copy
+import math
+
+from collections import defaultdict
+
+import numpy as np
+
+from anticipation.config import *
+from anticipation.vocab import *
+
+
+class TimeIndex:
+    """
+    The times of a sequence (events and controls alike) in sorted order.
+
+    A time window of the sequence is located by bisection. If the sequence is
+    already in order of time, as it usually is, no permutation is stored and
+    every window is a contiguous slice of the sequence.
+    """
+
+    def __init__(self, times, order=None):
+        if order is None and np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+
+        self.order = order
+        self.times = times if order is None else times[order]
+
+    def window(self, start, end):
+        """ the positions (in sequence order) of the tokens with start <= time <= end """
+        lo = int(np.searchsorted(self.times, start, side='left'))
+        hi = int(np.searchsorted(self.times, end, side='right'))
+        if self.order is None:
+            return slice(lo, max(lo, hi))
+
+        return np.sort(self.order[lo:hi])
+
+    def shift(self, dt):
+        index = TimeIndex.__new__(TimeIndex)
+        index.order = self.order
+        index.times = self.times + dt
+        return index
+
+
+def tick_bounds(start, end):
+    """ the ticks strictly between start and end seconds, as compared by ops.mask """
+    first = math.floor(TIME_RESOLUTION*start) - 1
+    while first/float(TIME_RESOLUTION) <= start:
+        first += 1
+
+    last = math.ceil(TIME_RESOLUTION*end) + 1
+    while last/float(TIME_RESOLUTION) >= end:
+        last -= 1
+
+    return first, last
+
+
+class TokenSequence:
+    """
+    A sequence of (time, duration, note) triples stored as an (n,3) int32 array.
+
+    Each method mirrors the function of the same name in anticipation.ops and
+    produces the same result, but operates on whole columns at once. Convert
+    to and from the flat token lists used elsewhere with TokenSequence(tokens)
+    and tolist(); len() counts tokens, as it does for a flat list.
+
+    With index=True, the sequence carries a TimeIndex, so that clip and mask
+    locate their window in O(log n) and only touch the tokens they keep (for
+    clip) or drop (for mask). The index is carried over to the results of
+    clip, mask and translate where it remains valid.
+    """
+
+    def __init__(self, tokens=(), index=False):
+        if isinstance(tokens, TokenSequence):
+            tokens = tokens.array
+
+        self.array = np.ascontiguousarray(np.asarray(tokens, dtype=np.int32).reshape(-1, 3))
+        self.index = TimeIndex(self.times()) if index else None
+
+    def indexed(self, index=None):
+        """ this sequence, with a time index """
+        if index is None:
+            index = self.index if self.index is not None else TimeIndex(self.times())
+
+        self.index = index
+        return self
+
+    def __len__(self):
+        return self.array.size
+
+    def __add__(self, other):
+        return TokenSequence(np.concatenate([self.array, TokenSequence(other).array]))
+
+    def __eq__(self, other):
+        return isinstance(other, TokenSequence) and np.array_equal(self.array, other.array)
+
+    def __repr__(self):
+        return f'TokenSequence({self.tolist()})'
+
+    def tolist(self):
+        return self.array.reshape(-1).tolist()
+
+    @property
+    def time(self):
+        return self.array[:,0]
+
+    @property
+    def dur(self):
+        return self.array[:,1]
+
+    @property
+    def note(self):
+        return self.array[:,2]
+
+    def is_control(self):
+        return self.note >= CONTROL_OFFSET
+
+    def times(self):
+        """ the time of each event or control, in ticks """
+        return np.where(self.is_control(), self.time - ATIME_OFFSET, self.time - TIME_OFFSET)
+
+    def durations(self):
+        return np.where(self.is_control(), self.dur - ADUR_OFFSET, self.dur - DUR_OFFSET)
+
+    def notes(self):
+        return np.where(self.is_control(), self.note - ANOTE_OFFSET, self.note - NOTE_OFFSET)
+
+    def separator(self):
+        """ the index of the first sequence separator (or the length of the sequence) """
+        separators = np.flatnonzero(self.note == SEPARATOR)
+        return int(separators[0]) if len(separators) > 0 else len(self.array)
+
+    def select(self, keep):
+        return TokenSequence(self.array[keep])
+
+    def clip(self, start, end, clip_duration=True, seconds=True):
+        if seconds:
+            start = int(TIME_RESOLUTION*start)
+            end = int(TIME_RESOLUTION*end)
+
+        if self.index is not None:
+            clipped = TokenSequence(self.array[self.index.window(start, end)].copy())
+        else:
+            times = self.times()
+            clipped = self.select((start <= times) & (times <= end))
+
+        # truncate extended notes
+        if clip_duration:
+            overhang = clipped.times() + clipped.durations() - end
+            clipped.array[:,1] -= np.maximum(overhang, 0).astype(np.int32)
+
+        if self.index is not None and self.index.order is None:
+            clipped.indexed(TimeIndex(clipped.times(), order=None))
+
+        return clipped
+
+    def mask(self, start, end):
+        if self.index is None:
+            times = self.times()/float(TIME_RESOLUTION)
+            return self.select(~((start < times) & (times < end)))
+
+        first, last = tick_bounds(start, end)
+        window = self.index.window(first, last)
+        if isinstance(window, slice):
+            masked = TokenSequence(np.concatenate([self.array[:window.start], self.array[window.stop:]]))
+            return masked.indexed(TimeIndex(masked.times(), order=None))
+
+        keep = np.ones(len(self.array), dtype=bool)
+        keep[window] = False
+        return self.select(keep)
+
+    def delete(self, criterion):
+        """ delete the triples for which criterion(time, dur, note) holds, evaluated on whole columns """
+        return self.select(~np.asarray(criterion(self.time, self.dur, self.note), dtype=bool))
+
+    def sort(self):
+        """ sort sequence of events or controls (but not both) """
+        return TokenSequence(self.array[np.argsort(self.time, kind='stable')])
+
+    def split(self):
+        """ split a sequence into events and controls """
+        controls = self.is_control()
+        return self.select(~controls), self.select(controls)
+
+    def pad(self, end_time=None, density=TIME_RESOLUTION):
+        end_time = TIME_OFFSET+(end_time if end_time else self.max_time(seconds=False))
+
+        # must pad before separation, anticipation
+        assert np.all(self.note < CONTROL_OFFSET)
+
+        # insert pad tokens to ensure the desired density: gap j is padded after previous[j]
+        time = self.time.astype(np.int64)
+        previous = np.concatenate([[TIME_OFFSET+0], time])
+        following = np.concatenate([time, [end_time]])
+        counts = np.maximum((following - previous - 1)//density, 0)
+
+        rests = np.zeros((int(counts.sum()), 3), dtype=np.int32)
+        rank = np.arange(len(rests)) - np.repeat(np.cumsum(counts) - counts, counts)
+        rests[:,0] = np.repeat(previous, counts) + (rank + 1)*density
+        rests[:,1] = DUR_OFFSET+0
+        rests[:,2] = REST
+
+        padded = np.zeros((len(self.array) + len(rests), 3), dtype=np.int32)
+        positions = np.arange(len(self.array)) + np.cumsum(counts[:-1])
+        is_event = np.zeros(len(padded), dtype=bool)
+        is_event[positions] = True
+        padded[is_event] = self.array
+        padded[~is_event] = rests
+
+        return TokenSequence(padded)
+
+    def unpad(self):
+        return self.select(self.note != REST)
+
+    def anticipate(self, controls, delta=DELTA*TIME_RESOLUTION):
+        """
+        Interleave a sequence of events with anticipated controls.
+
+        Inputs:
+          controls : a sequence of time-localized controls
+          delta    : the anticipation interval
+
+        Returns:
+          tokens   : interleaved events and anticipated controls
+          controls : unconsumed controls (control time > max_time(events) + delta)
+        """
+        controls = TokenSequence(controls)
+        assert np.all(self.note < CONTROL_OFFSET)
+        if len(controls) == 0:
+            return TokenSequence(self.array), controls
+
+        # before event j, every control up to the first control later than delta
+        # after the latest preceding event is consumed
+        preceding = np.maximum.accumulate(np.concatenate([[0], self.time.astype(np.int64) - TIME_OFFSET]))[:-1]
+        latest_control = np.maximum.accumulate(controls.time.astype(np.int64) - ATIME_OFFSET)
+        consumed = np.searchsorted(latest_control - delta, preceding, side='right')
+
+        # sort key: events at odd positions, each control just before the event that consumed it
+        anticipated = int(consumed[-1]) if len(consumed) > 0 else 0
+        keys = np.concatenate([2*np.arange(len(self.array)) + 1,
+                               2*np.searchsorted(consumed, np.arange(anticipated), side='right')])
+        tokens = np.concatenate([self.array, controls.array[:anticipated]])[np.argsort(keys, kind='stable')]
+
+        return TokenSequence(tokens), TokenSequence(controls.array[anticipated:])
+
+    def sparsity(self):
+        tokens = self.array[self.note != SEPARATOR]
+        assert np.all(tokens[:,2] < CONTROL_OFFSET) # don't operate on interleaved sequences
+
+        if len(tokens) == 0:
+            return 0
+
+        time = tokens[:,0].astype(np.int64)
+        return max(int(np.max(np.diff(time, prepend=TIME_OFFSET+0))), 0)
+
+    def _instrument_times(self, instr):
+        # stop calculating at sequence separator
+        end = self.separator()
+        times = self.times()[:end]
+        if instr is not None:
+            times = times[self.notes()[:end]//2**7 == instr]
+
+        return times
+
+    def min_time(self, seconds=True, instr=None):
+        times = self._instrument_times(instr)
+        mt = int(times.min()) if len(times) > 0 else 0
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def max_time(self, seconds=True, instr=None):
+        times = self._instrument_times(instr)
+        mt = max(int(times.max()), 0) if len(times) > 0 else 0
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def get_instruments(self):
+        notes = self.notes()[self.note < SPECIAL_OFFSET]
+        instrs, first, counts = np.unique(notes//2**7, return_index=True, return_counts=True)
+
+        # in order of first appearance, as in ops.get_instruments
+        instruments = defaultdict(int)
+        for j in np.argsort(first):
+            instruments[int(instrs[j])] = int(counts[j])
+
+        return instruments
+
+    def translate(self, dt, seconds=False):
+        if seconds:
+            dt = int(TIME_RESOLUTION*dt)
+
+        # stop translating after EOT
+        end = self.separator()
+        if self.index is not None and end == len(self.array):
+            assert len(self.array) == 0 or 0 <= self.index.times[0] + dt
+        else:
+            assert np.all(0 <= self.times()[:end] + dt)
+
+        translated = TokenSequence(self.array.copy())
+        translated.array[:end,0] += dt
+        if self.index is not None and end == len(self.array):
+            translated.indexed(self.index.shift(dt))
+
+        return translated
+
+    def combine(self, controls):
+        controls = TokenSequence(controls)
+        return (self + (controls.array - CONTROL_OFFSET)).sort()
+
+
+class SequenceMetadata:
+    """
+    Summary statistics of a flat token sequence, computed in one pass.
+
+    Answers the queries of ops.min_time, ops.max_time (overall or per
+    instrument) and ops.get_instruments with the same results, without
+    rescanning the sequence. As in ops, times are only collected up to the
+    first sequence separator. Extend the metadata as tokens are appended to
+    the sequence, or translate it along with the sequence.
+    """
+
+    def __init__(self, tokens=()):
+        self.length = 0          # number of triples
+        self.events = 0
+        self.controls = 0
+        self.separators = []     # triple index of each sequence separator
+        self.instruments = defaultdict(int)
+        self.min_times = {}      # instrument -> min time (ticks)
+        self.max_times = {}      # instrument -> max time (ticks)
+        self.extend(tokens)
+
+    def extend(self, tokens):
+        tokens = TokenSequence(tokens)
+        notes = tokens.notes()
+        instrs = notes//2**7
+
+        separators = np.flatnonzero(tokens.note == SEPARATOR)
+        self.separators.extend((self.length + separators).tolist())
+        self.controls += int(np.count_nonzero(tokens.is_control())) - len(separators)
+        self.events += len(tokens.array) - int(np.count_nonzero(tokens.is_control()))
+
+        # instrument histogram, in order of first appearance
+        counted = instrs[tokens.note < SPECIAL_OFFSET]
+        unique, first, counts = np.unique(counted, return_index=True, return_counts=True)
+        for j in np.argsort(first):
+            self.instruments[int(unique[j])] += int(counts[j])
+
+        # stop collecting times at sequence separator
+        if len(self.separators) == len(separators):
+            end = tokens.separator()
+            unique, inverse = np.unique(instrs[:end], return_inverse=True)
+            times = tokens.times()[:end]
+            min_times = np.full(len(unique), np.iinfo(np.int64).max)
+            max_times = np.full(len(unique), np.iinfo(np.int64).min)
+            np.minimum.at(min_times, inverse, times)
+            np.maximum.at(max_times, inverse, times)
+            for instr, lo, hi in zip(unique.tolist(), min_times.tolist(), max_times.tolist()):
+                self.min_times[instr] = min(self.min_times.get(instr, lo), lo)
+                self.max_times[instr] = max(self.max_times.get(instr, hi), hi)
+
+        self.length += len(tokens.array)
+        return self
+
+    def append(self, token):
+        time, dur, note = token
+        self.length += 1
+
+        if note == SEPARATOR:
+            self.separators.append(self.length-1)
+        elif note < CONTROL_OFFSET:
+            self.events += 1
+        else:
+            self.controls += 1
+
+        special = note >= SPECIAL_OFFSET
+        if note < CONTROL_OFFSET:
+            time -= TIME_OFFSET
+            note -= NOTE_OFFSET
+        else:
+            time -= ATIME_OFFSET
+            note -= ANOTE_OFFSET
+
+        instr = note//2**7
+        if not special:
+            self.instruments[instr] += 1
+
+        # stop collecting times at sequence separator
+        if self.separators:
+            return
+
+        if instr not in self.min_times or time < self.min_times[instr]:
+            self.min_times[instr] = time
+
+        if instr not in self.max_times or time > self.max_times[instr]:
+            self.max_times[instr] = time
+
+    def min_time(self, seconds=True, instr=None):
+        if instr is None:
+            mt = min(self.min_times.values()) if self.min_times else 0
+        else:
+            mt = self.min_times.get(instr, 0)
+
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def max_time(self, seconds=True, instr=None):
+        if instr is None:
+            mt = max(self.max_times.values()) if self.max_times else 0
+        else:
+            mt = self.max_times.get(instr, 0)
+
+        mt = max(mt, 0)
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def get_instruments(self):
+        return defaultdict(int, self.instruments)
+
+    def translate(self, dt, seconds=False):
+        """ the metadata of the sequence translated by ops.translate """
+        if seconds:
+            dt = int(TIME_RESOLUTION*dt)
+
+        translated = copy.copy(self)
+        translated.separators = self.separators.copy()
+        translated.instruments = defaultdict(int, self.instruments)
+        translated.min_times = {instr : time + dt for instr, time in self.min_times.items()}
+        translated.max_times = {instr : time + dt for instr, time in self.max_times.items()}
+        return translated
@@ -0,0 +1,202 @@
+"""
+A local server for sampling from anticipatory infilling models.
+
+The server keeps a single model loaded and decodes all outstanding requests
+together: new requests join the running decode batch as soon as they arrive,
+and completed requests leave it (continuous batching).
+
+Requests are HTTP POSTs to /generate with a JSON body containing the arguments
+of sample.generate (start_time, end_time, inputs, controls, top_p, global_control).
+The response is a MIDI file of the generated events combined with the controls.
+A request is dropped from the decode batch if its client disconnects.
+"""
+
+import asyncio
+import io
+import json
+
+from argparse import ArgumentParser
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import events_to_midi, compound_to_midi
+from anticipation.sample import Generation, Constraints, BatchKVCache, Nucleus, add_token_batch
+
+
+class GenerationServer:
+    def __init__(self, model, max_batch=8, slot_head=False):
+        self.model = model
+        self.max_batch = max_batch
+        self.slot_head = slot_head
+
+        self.pending = asyncio.Queue()
+        self.active = {} # request id -> (state, constraints, top_p, future)
+        self.cache = BatchKVCache()
+        self.sampler = Nucleus()
+        self.requests = 0
+
+    async def generate(self, start_time, end_time, inputs=None, controls=None, top_p=1.0, global_control=None):
+        """ submit a request to the decode batch and wait for the generated events """
+        state = Generation(start_time, end_time, inputs, controls, global_control=global_control)
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((state, top_p, future))
+        return await future
+
+    def admit(self, request):
+        state, top_p, future = request
+        self.active[self.requests] = (state, Constraints(self.model.device), top_p, future)
+        self.requests += 1
+
+    def step(self):
+        """ sample one event for every active request; returns the ids of completed requests """
+        ids = list(self.active.keys())
+        states, constraints, top_p, _ = zip(*self.active.values())
+
+        new_tokens = add_token_batch(self.model,
+                [state.z for state in states],
+                [state.tokens for state in states],
+                list(top_p),
+                [max(state.start_time, state.current_time) for state in states],
+                cache=self.cache, ids=ids, constraints=list(constraints), slot_head=self.slot_head,
+                sampler=self.sampler)
+
+        completed = []
+        for idx, state, new_token in zip(ids, states, new_tokens):
+            state.append(new_token)
+            if state.done:
+                completed.append(idx)
+
+        return completed
+
+    async def decode(self):
+        """ the decoding loop: admit pending requests between steps of the running batch """
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.active:
+                self.admit(await self.pending.get())
+
+            while len(self.active) < self.max_batch and not self.pending.empty():
+                self.admit(self.pending.get_nowait())
+
+            # drop requests whose clients have gone away (see handle)
+            for idx in [idx for idx, (_, _, _, future) in self.active.items() if future.done()]:
+                del self.active[idx]
+
+            if not self.active:
+                continue
+
+            for state, _, _, _ in self.active.values():
+                state.anticipate()
+
+            try:
+                completed = await loop.run_in_executor(None, self.step)
+            except Exception as e:
+                for _, _, _, future in self.active.values():
+                    if not future.done():
+                        future.set_exception(e)
+
+                self.active.clear()
+                continue
+
+            for idx in completed:
+                state, _, _, future = self.active.pop(idx)
+                if not future.done():
+                    future.set_result(state.events())
+
+    async def handle(self, reader, writer):
+        """ serve a single HTTP request """
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while (line := (await reader.readline()).decode().strip()):
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if method != 'POST' or path != '/generate':
+                await respond(writer, 404, b'not found\n')
+                return
+
+            try:
+                params = json.loads(body) if body else {}
+                for arg in ['inputs', 'controls']:
+                    if len(params.get(arg) or []) % 3 != 0:
+                        raise ValueError(f'{arg} must be a sequence of (time, duration, note) triples')
+
+                generation = asyncio.create_task(self.generate(**params))
+            except (TypeError, ValueError, AttributeError) as e:
+                await respond(writer, 400, f'bad request: {e}\n'.encode())
+                return
+
+            # the client sends nothing more, so the end of its stream means it disconnected
+            disconnect = asyncio.create_task(reader.read())
+            await asyncio.wait([generation, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if not generation.done():
+                generation.cancel() # cancels the request's future, so decode drops it
+                return
+
+            disconnect.cancel()
+            try:
+                events = generation.result()
+            except (TypeError, ValueError, AssertionError) as e:
+                await respond(writer, 400, f'bad request: {e}\n'.encode())
+                return
+
+            tokens = ops.combine(events, params.get('controls') or [])
+            midi = io.BytesIO()
+            (events_to_midi(tokens) if tokens else compound_to_midi([])).save(file=midi)
+            await respond(writer, 200, midi.getvalue(), 'audio/midi')
+        except Exception as e:
+            await respond(writer, 500, f'error: {e}\n'.encode())
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, socket=None):
+        decoder = asyncio.create_task(self.decode())
+        if socket:
+            server = await asyncio.start_unix_server(self.handle, path=socket)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+
+        async with server:
+            await asyncio.gather(server.serve_forever(), decoder)
+
+
+async def respond(writer, status, body, content_type='text/plain'):
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f'HTTP/1.1 {status} {reason}\r\n'.encode())
+    writer.write(f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'.encode())
+    writer.write(b'Connection: close\r\n\r\n')
+    writer.write(body)
+    await writer.drain()
+
+
+def main(args):
+    from transformers import AutoModelForCausalLM
+
+    print(f'Serving model checkpoint: {args.model}')
+    model = AutoModelForCausalLM.from_pretrained(args.model).to(args.device).eval()
+
+    server = GenerationServer(model, max_batch=args.batch, slot_head=args.slot_head)
+    if args.socket:
+        print(f'Listening on {args.socket}')
+    else:
+        print(f'Listening on http://{args.host}:{args.port}/generate')
+
+    asyncio.run(server.serve(args.host, args.port, args.socket))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='serve an anticipatory model for local generation')
+    parser.add_argument('model', help='directory (or hub name) of a model checkpoint')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('-s', '--socket', type=str, default=None,
+            help='listen on a unix socket instead of a TCP port')
+    parser.add_argument('-b', '--batch', type=int, default=8,
+            help='maximum number of requests decoded together')
+    parser.add_argument('-d', '--device', type=str, default='cpu', help='device to run the model on')
+    parser.add_argument('--slot_head', action='store_true',
+            help='evaluate the output embedding only over the vocabulary legal at each slot')
+    main(parser.parse_args())
@@ -5,16 +5,18 @@ NUM_INSTRS = 16
 M_ALT = 336
 
 from tqdm import tqdm
+from itertools import chain
 import random
 import numpy as np
 import mido, scipy
 import copy
 
 from numpy import log
-from scipy.stats import lognorm
 from scipy.stats import gamma
 from mido import tick2second, second2tick, bpm2tempo, tempo2bpm, MidiFile
 from anticipation import ops
+from anticipation.sequence import SequenceMetadata
+from anticipation.dataset import SequenceWriter
 from anticipation.config import *
 from anticipation.vocab import *
 from anticipation.convert import compound_to_events, midi_to_interarrival, interarrival_to_midi
@@ -87,7 +89,8 @@ def maybe_tokenize(compound_tokens):
         return None, None, 1 # short track
 
     events, truncations = compound_to_events(compound_tokens, stats=True)
-    end_time = ops.max_time(events, seconds=False)
+    metadata = SequenceMetadata(events)
+    end_time = metadata.max_time(seconds=False)
 
     # don't want to deal with extremely short tracks
     if end_time < TIME_RESOLUTION*MIN_TRACK_TIME_IN_SECONDS:
@@ -98,22 +101,21 @@ def maybe_tokenize(compound_tokens):
         return None, None, 2 # long track
 
     # skip sequences more instruments than MIDI channels (16)
-    if len(ops.get_instruments(events)) > MAX_TRACK_INSTR:
+    if len(metadata.get_instruments()) > MAX_TRACK_INSTR:
         return None, None, 3 # too many instruments
 
     return events, truncations, 0
 
 
-def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False):
+def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False, binary=False):
     assert augment_factor == 1 # can't augment interarrival-tokenized data
 
     all_truncations = 0
-    seqcount = rest_count = 0
+    rest_count = 0
     stats = 4*[0] # (short, long, too many instruments, inexpressible)
     np.random.seed(0)
 
-    with open(output, 'w') as outfile:
-        concatenated_tokens = []
+    with SequenceWriter(output, CONTEXT_SIZE, binary=binary) as writer:
         for j, filename in tqdm(list(enumerate(datafiles)), desc=f'#{idx}', position=idx+1, leave=True):
             with open(filename, 'r') as f:
                 _, _, status = maybe_tokenize([int(token) for token in f.read().split()])
@@ -127,16 +129,12 @@ def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False):
             # already parsed; shouldn't raise an exception
             tokens, truncations = midi_to_interarrival(filename, stats=True)
             tokens[0:0] = [MIDI_SEPARATOR]
-            concatenated_tokens.extend(tokens)
             all_truncations += truncations
 
             # write out full sequences to file
-            while len(concatenated_tokens) >= CONTEXT_SIZE:
-                seq = concatenated_tokens[0:CONTEXT_SIZE]
-                concatenated_tokens = concatenated_tokens[CONTEXT_SIZE:]
-                outfile.write(' '.join([str(tok) for tok in seq]) + '\n')
-                seqcount += 1
+            writer.extend(tokens)
 
+    seqcount = writer.count
     if debug:
         fmt = 'Processed {} sequences (discarded {} tracks, discarded {} seqs, added {} rest tokens)'
         print(fmt.format(seqcount, stats[0]+stats[1]+stats[2], stats[3], rest_count))
@@ -144,31 +142,13 @@ def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False):
     return (seqcount, rest_count, stats[0], stats[1], stats[2], stats[3], all_truncations)
 
 def arrival_to_interarrival(control_tokens):
-    time_tokens = control_tokens[0::3]
-    if len(time_tokens) >= 2:
-        firsts = time_tokens[1:]
-        lasts = time_tokens[:-1]
-        diffs = []
-        for i in range(len(time_tokens) - 1):
-            diffs.append(firsts[i] - lasts[i])
-        time_tokens[1:] = diffs
-    control_tokens[0::3] = time_tokens
+    time_tokens = np.array(control_tokens[0::3], dtype=np.int64)
+    control_tokens[0::3] = np.diff(time_tokens, prepend=0).tolist()
     return control_tokens
 
 def interarrival_to_arrival(control_tokens):
-    arrival_tokens = control_tokens[0::3]
-    firsts = arrival_tokens[1:]
-    lasts = arrival_tokens[:-1]
-    absolutes = []
-    for i in range(len(arrival_tokens) - 1):
-      sum = 0
-      for k in range(i):
-          sum += lasts[k]
-      absolute = firsts[i] + lasts[i] + sum
-      absolutes.append(absolute)
-    arrival_tokens[1:] = absolutes
-    arrival_tokens[0] = arrival_tokens[0]
-    control_tokens[0::3] = arrival_tokens
+    time_tokens = np.array(control_tokens[0::3], dtype=np.int64)
+    control_tokens[0::3] = np.cumsum(time_tokens).tolist()
     return control_tokens
 
 def solve_for_log_normal_parameters(mean, variance):
@@ -176,7 +156,10 @@ def solve_for_log_normal_parameters(mean, variance):
         mu = log(mean) - sigma2/2
         return (mu, sigma2)
 
-def add_noise(midi_events, noise_level=0.00001):
+def add_noise(midi_events, noise_level=0.00001, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+
     controls = arrival_to_interarrival(midi_events)
     assert len([tok for tok in controls if tok == SEPARATOR]) % 3 == 0
     
@@ -189,45 +172,162 @@ def add_noise(midi_events, noise_level=0.00001):
     #smaller alpha & beta will have greater variance
     #greater alpha & beta will have smaller variance
     #random variable whose mean is one (range from 0 to infinity)
-    for i in range(len(controls)//3):
-        controls[i*3] = round(controls[i*3] * (lognorm.rvs(s=sigma, scale=np.exp(mu))))
+    #one draw per event, i.e. lognorm.rvs(s=sigma, scale=np.exp(mu), size=n)
+    noise = rng.lognormal(mean=mu, sigma=sigma, size=len(controls)//3)
+    controls[0::3] = np.round(np.array(controls[0::3]) * noise).astype(np.int64).tolist()
 
     controls = interarrival_to_arrival(controls)
     return controls
 
-def distort(controls, noise_level):
-    assert len([tok for tok in controls if tok == SEPARATOR]) % 3 == 0
+def distort(controls, noise_level, rng=None):
+    return distort_batch(controls, [noise_level], rng)[0]
 
-    # adding noise from a log normal distribution to the controls
-    controls = [tok - CONTROL_OFFSET for tok in controls]
-    controls = add_noise(controls, noise_level)
+def distort_batch(controls, noise_levels, rng=None):
+    """
+    Distort a melody (as controls) once for each noise level.
+
+    Inter-arrival times are scaled by lognormal noise (as in add_noise), notes
+    are folded into the octave C4-C5 and every instrument becomes a piano.
+    This operates on the control tokens directly, with one lognormal draw for
+    all noise levels.
+    """
+    assert len([tok for tok in controls if tok == SEPARATOR]) % 3 == 0
+    if rng is None:
+        rng = np.random.default_rng()
 
-    compound = events_to_compound(controls)
-    if len(compound) == 0:
-        return []
+    controls = np.array(controls, dtype=np.int64).reshape(-1, 3) - CONTROL_OFFSET
+    controls = controls[(controls[:,2] != REST - CONTROL_OFFSET) & (controls[:,2] != SEPARATOR - CONTROL_OFFSET)]
+    if len(controls) == 0 or np.any(controls[:,1] - DUR_OFFSET > MAX_DUR):
+        return [[] for _ in noise_levels]
 
-    # moving all notes to be in octave C4-C5
-    for i in range(len(compound[2::5])):
-        compound[i*5 + 2] = (compound[i*5 + 2] % 12) + 60
+    # adding noise from a log normal distribution to the controls
+    noise_levels = np.array([level if level > 0 else 0.00001 for level in noise_levels])
+    mu, sigma = solve_for_log_normal_parameters(1, noise_levels)
+    noise = rng.lognormal(mean=mu[:,None], sigma=sigma[:,None], size=(len(noise_levels), len(controls)))
+    interarrivals = np.diff(controls[:,0], prepend=0)
+    times = np.cumsum(np.round(interarrivals*noise).astype(np.int64), axis=1)
+    assert np.all(times >= TIME_OFFSET)
+
+    # moving all notes to be in octave C4-C5 and turning all instruments to piano
+    notes = NOTE_OFFSET + ((controls[:,2] - NOTE_OFFSET) % MAX_PITCH) % 12 + 60
+    durs = DUR_OFFSET + np.minimum(controls[:,1] - DUR_OFFSET, MAX_DUR-1)
+
+    distorted = np.empty((len(noise_levels), len(controls), 3), dtype=np.int64)
+    distorted[:,:,0] = times
+    distorted[:,:,1] = durs
+    distorted[:,:,2] = notes
+    return [(CONTROL_OFFSET + tokens).reshape(-1).tolist() for tokens in distorted]
+
+def random_state(seed):
+    """ returns (numpy Generator, random.Random, numpy RandomState) seeded by a sequence of ints """
+    seed = list(seed)
+    rng = np.random.default_rng(seed)
+    py_random = random.Random(str(seed))
+    np_random = np.random.RandomState(np.random.SeedSequence(seed).generate_state(1))
+    return rng, py_random, np_random
+
+
+def augment(all_events, augment_factor, rng, py_random=random, np_random=np.random):
+    """
+    Generate the anticipated training tokens for each augmentation of a track.
+
+    Up to three melody instruments are chosen as controls, and each melody is
+    distorted at 10 random noise levels. Yields (melody instrument, tokens,
+    number of REST events) for each augmentation.
+    """
+    instruments = list(ops.get_instruments(all_events).keys())
+    melody_instrs = []
+    for instr in instruments:
+        if instr >= 24 and instr <= 79:
+            melody_instrs.append(instr)
+
+    for k in range(augment_factor):
+
+        events = all_events.copy()
+
+        if len([tok for tok in events if tok == SEPARATOR]) % 3 != 0:
+            continue
+
+        for i in range(3):
+            if len(melody_instrs) == 0:
+                continue
 
-    # turning all instruments to piano
-    for i in range(len(compound[3::5])):
-        compound[i*5 + 3] = 0
+            melody_instr_index = py_random.randint(0, len(melody_instrs) - 1)
+            instr = melody_instrs.pop(melody_instr_index)
+            _, controls_orig = extract_instruments(events, [instr])
 
-    result_controls = compound_to_events(compound)
-    result_controls = [CONTROL_OFFSET + tok for tok in result_controls]
+            if len([tok for tok in controls_orig if tok == SEPARATOR]) % 3 != 0:
+                continue
 
-    return result_controls
+            noise_levels = 0.35000 * np_random.rand(10)
+            for controls in distort_batch(controls_orig, noise_levels, rng):
+                if len(controls) == 0:
+                    continue
 
-def tokenize(datafiles, output, augment_factor, idx=0, debug=False):
-    tokens = []
+                combined_events = controls + events
+                end_time = ops.max_time(combined_events, seconds=False)
+                events = ops.pad(events, end_time)
+                rests = sum(1 if tok == REST else 0 for tok in events[2::3])
+                tokens, controls = ops.anticipate(events, controls)
+                assert len(controls) == 0 # should have consumed all controls (because of padding)
+                tokens[0:0] = [SEPARATOR, SEPARATOR, SEPARATOR]
+
+                yield instr, tokens, rests
+
+
+def prepare_sequence(seq, instr, stats, py_random=random):
+    """ relativize a training sequence and prefix its instruments, or return None to discard it """
+    metadata = SequenceMetadata(seq)
+    instr_list = list(metadata.get_instruments().keys())
+    py_random.shuffle(instr_list)
+    while len(instr_list) < NUM_INSTRS:
+        instr_list.append(55026)
+    if instr in instr_list:
+        instr_index = instr_list.index(instr)
+        if instr_index != 0:
+            instr_list[0], instr_list[instr_index] = instr_list[instr_index], instr_list[0]
+
+    try:
+        # relativize time to the sequence
+        dt = -metadata.min_time(seconds=False)
+        seq = ops.translate(seq, dt, seconds=False)
+        metadata = metadata.translate(dt)
+
+        # should have relativized to zero
+        assert metadata.min_time(seconds=False) == 0
+    except OverflowError:
+        # relativized time exceeds MAX_TIME
+        stats[3] += 1
+        return None
+
+    # get clips with at least 20 notes of melody
+    if metadata.get_instruments()[instr] < 20:
+        stats[4] += 1
+        return None
+
+    # melody line should start in the first 2 seconds of the sequence
+    if metadata.min_time(seconds=True, instr=instr) > 2:
+        stats[5] += 1
+        return None
+
+    # melody line should end in the last 2 seconds of the sequence
+    if metadata.max_time(seconds=True, instr=instr) < metadata.max_time() - 2:
+        stats[6] += 1
+        return None
+
+    # if seq contains SEPARATOR, global controls describe the first sequence
+    return instr_list + seq
+
+
+def tokenize(datafiles, output, augment_factor, idx=0, debug=False, binary=False):
     all_truncations = 0
-    seqcount = rest_count = 0
+    rest_count = 0
     stats = 7*[0] # (short, long, too many instruments, inexpressible, too few notes, starts too late, ends too early)
     np.random.seed(0)
+    rng = np.random.default_rng(0) # noise for control distortion
 
-    with open(output, 'w') as outfile:
-        concatenated_tokens = []
+    prepare = lambda seq: prepare_sequence(seq, instr, stats)
+    with SequenceWriter(output, EVENT_SIZE*M_ALT, binary=binary, prepare=prepare) as writer:
         for j, filename in tqdm(list(enumerate(datafiles)), desc=f'#{idx}', position=idx+1, leave=True):
             with open(filename, 'r') as f:
                 all_events, truncations, status = maybe_tokenize([int(token) for token in f.read().split()])
@@ -236,100 +336,126 @@ def tokenize(datafiles, output, augment_factor, idx=0, debug=False):
                 stats[status-1] += 1
                 continue
 
-            instruments = list(ops.get_instruments(all_events).keys())
-            melody_instrs = []
-            for instr in instruments:
-                if instr >= 24 and instr <= 79:
-                    melody_instrs.append(instr)
-
-            for k in range(augment_factor):
-
-                events = all_events.copy()
-
-                if len([tok for tok in events if tok == SEPARATOR]) % 3 != 0:
-                    continue
-
-                for i in range(3):
-                    if len(melody_instrs) > 0:
-                        melody_instr_index = random.randint(0, len(melody_instrs) - 1)
-                        instr = melody_instrs.pop(melody_instr_index)
-                        _, controls_orig = extract_instruments(events, [instr])
-                        
-                        if len([tok for tok in controls_orig if tok == SEPARATOR]) % 3 != 0:
-                            continue
-                            
-                        else:                            
-                            for k in range(10):
-                                controls = copy.copy(controls_orig)
-                                noise_level = 0.35000 * np.random.rand()
-                                controls = distort(controls, noise_level)
-                                if len(controls) == 0:
-                                    continue
-                                assert len(controls) != 0
-                                combined_events = controls + events
-
-                                end_time = ops.max_time(combined_events, seconds=False)
-                                all_truncations += truncations
-                                events = ops.pad(events, end_time)
-                                rest_count += sum(1 if tok == REST else 0 for tok in events[2::3])
-                                tokens, controls = ops.anticipate(events, controls)
-                                assert len(controls) == 0 # should have consumed all controls (because of padding)
-                                tokens[0:0] = [SEPARATOR, SEPARATOR, SEPARATOR]
-                                concatenated_tokens.extend(tokens)
-    
-                                # write out full sequences to file
-                                while len(concatenated_tokens) >= EVENT_SIZE*M_ALT:
-                                    instr_list = list(ops.get_instruments(concatenated_tokens[0:EVENT_SIZE*M_ALT]).keys())
-                                    random.shuffle(instr_list)
-                                    while len(instr_list) < NUM_INSTRS:
-                                        instr_list.append(55026)
-                                    if instr in instr_list:
-                                        instr_index = instr_list.index(instr)
-                                        if instr_index != 0:
-                                            instr_list[0], instr_list[instr_index] = instr_list[instr_index], instr_list[0]
-
-                                    seq = concatenated_tokens[0:EVENT_SIZE*M_ALT]
-                                    concatenated_tokens = concatenated_tokens[EVENT_SIZE*M_ALT:]
-    
-                                    try:
-                                        # relativize time to the sequence
-                                        seq = ops.translate(
-                                                seq, -ops.min_time(seq, seconds=False), seconds=False)
-    
-                                        # should have relativized to zero
-                                        assert ops.min_time(seq, seconds=False) == 0
-                                    except OverflowError:
-                                        # relativized time exceeds MAX_TIME
-                                            stats[3] += 1
-                                            continue
-
-                                    # get clips with at least 20 notes of melody
-                                    if ops.get_instruments(seq)[instr] < 20:
-                                        stats[4] += 1
-                                        continue
-            
-                                    # melody line should start in the first 2 seconds of the sequence
-                                    if ops.min_time(seq, seconds=True, instr=instr) > 2:
-                                        stats[5] += 1
-                                        continue
-
-                                    # melody line should end in the last 2 seconds of the sequence
-                                    if ops.max_time(seq, seconds=True, instr=instr) < ops.max_time(seq) - 2:
-                                        stats[6] += 1
-                                        continue
-    
-                                    # if seq contains SEPARATOR, global controls describe the first sequence
-                                    seq = instr_list + seq
-    
-                                    outfile.write(' '.join([str(tok) for tok in seq]) + '\n')
-                                    seqcount += 1
-    
-                    else:
-                      continue
+            for instr, tokens, rests in augment(all_events, augment_factor, rng):
+                all_truncations += truncations
+                rest_count += rests
 
+                # write out full sequences to file
+                writer.extend(tokens)
 
+    seqcount = writer.count
     if debug:
         fmt = 'Processed {} sequences (discarded {} tracks, discarded {} seqs, added {} rest tokens)'
         print(fmt.format(seqcount, stats[0]+stats[1]+stats[2], stats[3]+stats[4]+stats[5]+stats[6], rest_count))
 
     return (seqcount, rest_count, stats[0], stats[1], stats[2], stats[3], stats[4], stats[5], stats[6], all_truncations)
+
+
+def augment_shard(datafiles, output, augment_factor, seed=(0,), interarrival=False):
+    """
+    Tokenize and augment a chunk of tracks for parallel tokenization.
+
+    The training token streams of the chunk (one per augmentation) are saved
+    to output (.npz) to be packed into sequences by pack_shard. Randomness is
+    seeded per chunk, so the shard doesn't depend on how chunks are scheduled.
+
+    Returns (tokens, rest tokens, short, long, too many instruments, truncations).
+    """
+    if interarrival:
+        assert augment_factor == 1 # can't augment interarrival-tokenized data
+
+    rng, py_random, np_random = random_state(seed)
+    streams, instrs = [], []
+    all_truncations = rest_count = 0
+    stats = 3*[0] # (short, long, too many instruments)
+    for filename in datafiles:
+        with open(filename, 'r') as f:
+            all_events, truncations, status = maybe_tokenize([int(token) for token in f.read().split()])
+
+        if status > 0:
+            stats[status-1] += 1
+            continue
+
+        if interarrival:
+            # already parsed; shouldn't raise an exception
+            tokens, truncations = midi_to_interarrival(filename[:-len('.compound.txt')], stats=True)
+            tokens[0:0] = [MIDI_SEPARATOR]
+            all_truncations += truncations
+            streams.append(tokens)
+            instrs.append(0)
+            continue
+
+        for instr, tokens, rests in augment(all_events, augment_factor, rng, py_random, np_random):
+            all_truncations += truncations
+            rest_count += rests
+            streams.append(tokens)
+            instrs.append(instr)
+
+    lengths = [len(tokens) for tokens in streams]
+    # streams aren't yet relativized: anticipated control times can exceed 16 bits in a long track
+    tokens = np.fromiter(chain.from_iterable(streams), dtype=np.int32, count=sum(lengths))
+
+    result = (len(tokens), rest_count, stats[0], stats[1], stats[2], all_truncations)
+    np.savez(output, tokens=tokens, ends=np.cumsum(lengths, dtype=np.int64),
+             instrs=np.array(instrs, dtype=np.int64), stats=np.array(result, dtype=np.int64))
+
+    return result
+
+
+def shard_windows(offsets, idx, length):
+    """
+    Locate the training sequences that begin in shard idx.
+
+    Returns (first, last, end): the windows [first, last) begin in shard idx
+    and read the token streams of shards [idx, end).
+    """
+    first = -(-offsets[idx] // length)
+    last = min(-(-offsets[idx+1] // length), offsets[-1] // length)
+
+    end = idx
+    while end < len(offsets)-1 and offsets[end] < last*length:
+        end += 1
+
+    return first, last, end
+
+
+def pack_shard(shards, offsets, idx, output, length, seed=(0,), binary=False, prepare=True):
+    """
+    Pack the training sequences that begin in shards[idx] for parallel tokenization.
+
+    Sequences are windows of the concatenation of all the shards' token streams
+    (offsets[j] is the position of shards[j] in the concatenation, followed by
+    the total length), as tokenize packs them; a window that runs past the end
+    of shards[idx] continues into the following shards. Each sequence is
+    prepared with a random state seeded by its window index.
+
+    Returns (sequences, inexpressible, too few notes, starts too late, ends too early).
+    """
+    first, last, end = shard_windows(offsets, idx, length)
+
+    stats = 7*[0] # see tokenize
+    with SequenceWriter(output, length, binary=binary) as writer:
+        if first < last:
+            tokens, ends, instrs = [], [], []
+            for j in range(idx, end):
+                with np.load(shards[j]) as shard:
+                    tokens.append(shard['tokens'])
+                    ends.append(offsets[j] + shard['ends'])
+                    instrs.append(shard['instrs'])
+
+            tokens = np.concatenate(tokens)
+            ends = np.concatenate(ends)
+            instrs = np.concatenate(instrs)
+
+            base = offsets[idx]
+            for w in range(first, last):
+                seq = tokens[w*length-base:(w+1)*length-base].tolist()
+                if prepare:
+                    # the melody of the stream that completes this window
+                    instr = int(instrs[np.searchsorted(ends, (w+1)*length-1, side='right')])
+                    seq = prepare_sequence(seq, instr, stats, py_random=random.Random(str([*seed, w])))
+
+                if seq is not None:
+                    writer.write(seq)
+
+    return (writer.count, stats[3], stats[4], stats[5], stats[6])
@@ -8,7 +8,7 @@ from transformers import AutoModelForCausalLM
 
 from anticipation import ops
 from anticipation.visuals import visualize
-from anticipation.sample import generate, generate_ar
+from anticipation.sample import generate_batch, generate_ar, PrefixCache
 from anticipation.tokenize import extract_instruments
 from anticipation.convert import midi_to_events, events_to_midi
 from anticipation.config import TIME_RESOLUTION
@@ -43,6 +43,7 @@ def main(args):
         except FileExistsError:
             pass
 
+    prefixes = PrefixCache() # reuse the prompt's key/value state across repeated samples
     print(f'Accompanying tracks in index : {args.dir}/index.csv')
     with open(f'{args.dir}/index.csv', newline='') as f:
         reader = csv.reader(f)
@@ -58,11 +59,17 @@ def main(args):
             events, controls = extract_instruments(events, [melody])
             prompt = ops.clip(events, 0, args.prompt_length, clip_duration=False)
 
+            if args.anticipatory:
+                t0 = time.time()
+                generated_batch = generate_batch(model, args.prompt_length, args.clip_length,
+                        args.multiplicity*[prompt], args.multiplicity*[controls], top_p=0.95, prefixes=prefixes)
+                print(f'Generated {args.multiplicity} anticipatory accompaniments. Sampling time: {time.time()-t0} seconds')
+
             for j in range(args.multiplicity):
                 t0 = time.time()
 
                 if args.anticipatory:
-                    generated_tokens = generate(model, args.prompt_length, args.clip_length, prompt, controls, top_p=0.95)
+                    generated_tokens = generated_batch[j]
                     output = ops.clip(ops.combine(generated_tokens, controls), 0, args.clip_length)
                     mid = events_to_midi(output)
                     mid.save(f'{args.dir}/anticipatory/{idx}-clip-v{j}.mid')
@@ -70,7 +77,7 @@ def main(args):
                         visualize(output, f'{args.dir}/anticipatory/{idx}-clip-v{j}.png')
 
                 if args.baseline:
-                    generated_tokens = generate_ar(model, args.prompt_length, args.clip_length, prompt, controls, top_p=0.95)
+                    generated_tokens = generate_ar(model, args.prompt_length, args.clip_length, prompt, controls, top_p=0.95, prefixes=prefixes)
                     output = ops.clip(generated_tokens, 0, args.clip_length)
                     print(len(generated_tokens), len(output))
                     mid = events_to_midi(output)
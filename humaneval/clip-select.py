@@ -8,6 +8,7 @@ import numpy as np
 from tqdm import tqdm
 
 from anticipation import ops
+from anticipation.sequence import TokenSequence
 from anticipation.visuals import visualize
 from anticipation.tokenize import extract_instruments
 from anticipation.convert import midi_to_events, events_to_midi
@@ -22,21 +23,21 @@ def select_sample(filenames, prompt_length, clip_length, verbose=False):
             print('Loading index: ', idx)
 
         try:
-            events = midi_to_events(filenames[idx])
+            events = TokenSequence(midi_to_events(filenames[idx]), index=True)
         except Exception:
             continue
 
-        max_time = ops.max_time(events) - clip_length
+        max_time = events.max_time() - clip_length
 
         # don't sample tracks with length shorter than clip_length
         if max_time < 0:
             if verbose:
-                print(f'  rejected: track is too short (length {ops.max_time(events)} < {clip_length})')
+                print(f'  rejected: track is too short (length {events.max_time()} < {clip_length})')
             continue
 
         start_time = max_time*np.random.rand(1)[0]
-        clip = ops.clip(events, start_time, start_time+clip_length, clip_duration=True)
-        clip = ops.translate(clip, -int(TIME_RESOLUTION*start_time))
+        clip = events.clip(start_time, start_time+clip_length, clip_duration=True)
+        clip = clip.translate(-int(TIME_RESOLUTION*start_time)).tolist()
 
         instruments = ops.get_instruments(clip).keys()
         if len(instruments) > 15:
@@ -8,7 +8,7 @@ from transformers import AutoModelForCausalLM
 
 from anticipation import ops
 from anticipation.visuals import visualize
-from anticipation.sample import generate
+from anticipation.sample import generate_batch
 from anticipation.convert import midi_to_events, events_to_midi
 
 np.random.seed(0)
@@ -40,10 +40,13 @@ def main(args):
 
             prompt = midi_to_events(os.path.join(args.dir, prompt_midi))
             start_time = ops.max_time(prompt)
-            for j in range(args.multiplicity):
-                t0 = time.time()
 
-                generated_tokens = generate(model, start_time, args.clip_length, prompt, controls=[], top_p=0.98)
+            t0 = time.time()
+            generated_batch = generate_batch(model, start_time, args.clip_length,
+                    args.multiplicity*[prompt], args.multiplicity*[[]], top_p=0.98)
+            print(f'Generated {args.multiplicity} completions of idx {idx}. Sampling time: {time.time()-t0} seconds')
+
+            for j, generated_tokens in enumerate(generated_batch):
                 output = ops.clip(generated_tokens, 0, args.clip_length)
                 mid = events_to_midi(output)
                 mid.save(f'{args.dir}/{args.output}/{idx}-clip-v{j}.mid')
@@ -51,9 +54,6 @@ def main(args):
                     visualize(output, f'{args.dir}/{args.output}/{idx}-clip-v{j}.png')
 
 
-                print(f'Generated completion of idx {idx}. Sampling time: {time.time()-t0} seconds')
-
-
 if __name__ == '__main__':
     parser = ArgumentParser(description='generate prompted completions')
     parser.add_argument('dir', help='directory containing an index of MIDI files')
@@ -9,19 +9,15 @@ from transformers import AutoModelForCausalLM
 from tqdm import tqdm
 
 from anticipation.config import EVENT_SIZE
+from anticipation.dataset import read_sequences
 
 def log_loss(model, datafile, subsample):
-    with open(datafile, 'r') as data:
-        ce = torch.empty(0)
-        for i,line in tqdm(list(enumerate(data))):
-            if i % subsample != 0:
-                continue
-
-            tokens = [int(token) for token in line.split()]
-            tokens = torch.tensor(tokens).unsqueeze(0).cuda()
-            with torch.no_grad():
-                logits = model(tokens).logits[0]
-                ce = torch.cat([ce, F.cross_entropy(logits[:-1],tokens[0,1:],reduction='none').cpu()])
+    ce = torch.empty(0)
+    for tokens in tqdm(list(read_sequences(datafile, step=subsample))):
+        tokens = torch.tensor(tokens).unsqueeze(0).cuda()
+        with torch.no_grad():
+            logits = model(tokens).logits[0]
+            ce = torch.cat([ce, F.cross_entropy(logits[:-1],tokens[0,1:],reduction='none').cpu()])
 
     return ce
 
@@ -71,7 +67,7 @@ def main(args):
             res['loss'] = np.round(ce.mean().item(), 3)
             if args.bpe:
                 # hardcoding length of the LakhMidi test set in hours: 560.98
-                assert os.path.basename(args.filename) == 'test.txt'
+                assert os.path.splitext(os.path.basename(args.filename))[0] == 'test'
                 res['bpe'] = args.subsample*ce.mean().item()*np.log2(np.e)*(len(ce) / (560.98*3600))
             if not args.interarrival:
                 res['event_ppl'] = np.round(np.exp(EVENT_SIZE*ce.mean().item()), 3)
@@ -0,0 +1,54 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+
+from anticipation.vocab import *
+from anticipation.sample import Constraints, Nucleus, nucleus
+
+
+def reference(logits, top_p):
+    probs = F.softmax(nucleus(logits.clone(), top_p), dim=-1)
+    return int(torch.multinomial(probs, 1))
+
+
+def main(args):
+    torch.manual_seed(0)
+    constraints = Constraints()
+    sampler = Nucleus()
+
+    print(f'Nucleus sampling benchmark (top_p = {args.top_p}, {args.trials} trials per slot)')
+    for slot, name in enumerate(['time', 'duration', 'note']):
+        # peaked logits, roughly like those of a trained model
+        logits = [constraints.apply(args.temperature*torch.randn(VOCAB_SIZE), slot, 100)
+                  for _ in range(args.trials)]
+
+        # check that both samplers agree on the nucleus
+        for l in logits[:10]:
+            kept = torch.isfinite(nucleus(l.clone(), args.top_p)).nonzero().flatten()
+            probs = F.softmax(l, dim=-1)
+            samples = set(sampler.sample(probs, args.top_p, slot) for _ in range(100))
+            assert samples <= set(kept.tolist())
+
+        t0 = time.time()
+        for l in logits:
+            reference(l, args.top_p)
+        ref_time = (time.time() - t0)/args.trials
+
+        t0 = time.time()
+        for l in logits:
+            sampler.sample(F.softmax(l, dim=-1), args.top_p, slot)
+        new_time = (time.time() - t0)/args.trials
+
+        print(f'  {name:>8} slot: nucleus {1e6*ref_time:.1f}us, Nucleus.sample {1e6*new_time:.1f}us'
+              f' ({ref_time/new_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='compare the nucleus sampler to the full-sort reference')
+    parser.add_argument('-p', '--top_p', type=float, default=0.98, help='nucleus probability mass')
+    parser.add_argument('-n', '--trials', type=int, default=1000, help='samples per token slot')
+    parser.add_argument('-t', '--temperature', type=float, default=4.0,
+            help='scale of the random logits (larger is more peaked)')
+    main(parser.parse_args())
@@ -0,0 +1,51 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from transformers import AutoModelForCausalLM
+
+from anticipation import ops
+from anticipation.sample import generate, Profiler
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import midi_to_events
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = AutoModelForCausalLM.from_pretrained(args.model).to(args.device)
+
+    prompt, controls = [], None
+    if args.midi:
+        events = midi_to_events(args.midi)
+        if args.melody is not None:
+            events, controls = extract_instruments(events, [args.melody])
+        prompt = ops.clip(events, 0, args.start_time, clip_duration=False)
+
+    profiler = Profiler()
+    t0 = time.time()
+    generate(model, args.start_time, args.end_time, inputs=prompt, controls=controls, top_p=args.top_p,
+             use_cache=not args.no_cache, slot_head=args.slot_head, profiler=profiler)
+    print(f'Sampling time: {time.time()-t0} seconds')
+
+    print(profiler.summary())
+    if args.output:
+        profiler.write(args.output)
+        print(f'Wrote per-event trace to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='profile the latency of each stage of sampling')
+    parser.add_argument('model', help='checkpoint to sample from')
+    parser.add_argument('-o', '--output', help='file to write the JSONL trace to')
+    parser.add_argument('-f', '--midi', help='MIDI file to prompt with')
+    parser.add_argument('--melody', type=int, default=None,
+            help='instrument of the prompt MIDI file to use as anticipated controls')
+    parser.add_argument('-s', '--start_time', type=float, default=0, help='start time of generation (seconds)')
+    parser.add_argument('-e', '--end_time', type=float, default=20, help='end time of generation (seconds)')
+    parser.add_argument('-p', '--top_p', type=float, default=0.98, help='nucleus probability mass')
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--slot_head', action='store_true', help='restrict the LM head to each slot\'s vocabulary')
+    parser.add_argument('--no_cache', action='store_true', help='disable the key/value cache')
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+from argparse import ArgumentParser
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from anticipation.vocab import *
+from anticipation.sample import generate_batch, forward, forward_batch, BatchKVCache, PrefixCache
+
+
+def tiny_model(seed=0):
+    """ a small randomly initialized model, for checking the mechanics of sampling """
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=1024, n_embd=32, n_layer=2, n_head=2)
+    return GPT2LMHeadModel(config).eval()
+
+
+def check_empty(model, count):
+    """ batches of unconditional samples: empty (or missing) inputs and controls """
+    for kwargs in [dict(inputs_list=count*[[]]), dict(controls_list=count*[[]]),
+                   dict(inputs_list=count*[[]], controls_list=count*[[]])]:
+        samples = generate_batch(model, 0, 0.2, top_p=.98, **kwargs)
+        assert len(samples) == count
+        assert all(len(events) % 3 == 0 for events in samples)
+
+
+def check_admission(model):
+    """ sequences joining or leaving the batch don't recompute the cached rows of the others """
+    shapes = [] # (rows, tokens) evaluated by each forward pass
+    hook = model.register_forward_pre_hook(lambda module, args, kwargs: shapes.append(tuple(args[0].shape)),
+                                           with_kwargs=True)
+
+    g = torch.Generator().manual_seed(0)
+    seqs = {idx : torch.randint(0, 1000, (length,), generator=g).tolist() for idx, length in [(0, 5), (1, 7), (2, 6)]}
+    cache = BatchKVCache()
+    steps = [
+        ((0, 1), [(2, 7)]),            # prime the initial batch
+        ((0, 1, 2), [(2, 1), (1, 6)]), # extend rows 0 and 1 by a token; prime only the new row
+        ((0, 2), [(2, 1)]),            # row 1 leaves the batch
+    ]
+    with torch.no_grad():
+        for step, (ids, expected) in enumerate(steps):
+            for idx in ids:
+                if idx in cache.ids:
+                    seqs[idx] = seqs[idx] + torch.randint(0, 1000, (1,), generator=g).tolist()
+
+            shapes.clear()
+            logits = forward_batch(model, [seqs[idx] for idx in ids], cache, ids)
+            assert shapes == expected, f'step {step}: evaluated {shapes}, expected {expected}'
+            for j, idx in enumerate(ids):
+                assert torch.allclose(logits[j], forward(model, seqs[idx]), atol=1e-3)
+
+    hook.remove()
+
+
+def check_prefixes(model, count):
+    """ repeated samples from a prompt evaluate it once, and not at all once it is in a PrefixCache """
+    prompt = []
+    for t in range(0, TIME_RESOLUTION, 10):
+        prompt.extend([TIME_OFFSET+t, DUR_OFFSET+10, NOTE_OFFSET+60+t%12])
+
+    widths = [] # the number of rows and tokens evaluated by each forward pass
+    hook = model.register_forward_pre_hook(lambda module, args, kwargs: widths.append(tuple(args[0].shape)),
+                                           with_kwargs=True)
+
+    prefixes = PrefixCache()
+    samples, passes = [], []
+    for _ in range(2):
+        widths.clear()
+        torch.manual_seed(0)
+        samples.append(generate_batch(model, 1, 1.2, count*[prompt], top_p=.98, prefixes=prefixes))
+        passes.append(list(widths))
+
+    hook.remove()
+    assert passes[0][0][0] == 1, 'the prompt was evaluated for every sample'
+    assert max(tokens for _, tokens in passes[1]) < len(prompt), 'the prompt was evaluated again'
+    assert samples[0] == samples[1]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check batched sampling with a small random model')
+    parser.add_argument('-n', '--count', type=int, default=4,
+        help='number of sequences in each batch')
+    args = parser.parse_args()
+
+    model = tiny_model()
+    check_empty(model, args.count)
+    check_admission(model)
+    check_prefixes(model, args.count)
+    print('Batched sampling checks passed')
@@ -0,0 +1,50 @@
+import os
+import tempfile
+from argparse import ArgumentParser
+
+from anticipation.vocab import *
+from anticipation.config import *
+from anticipation.tokenize import M_ALT, NUM_INSTRS, augment_shard, pack_shard
+from anticipation.dataset import read_sequences
+
+
+def long_track(seconds):
+    """ compound tokens of a synthetic track: an accompaniment (piano) and a melody (program 53) """
+    # onsets are offset by a tick so that no time token collides with SEPARATOR
+    tokens = []
+    for t in range(1, seconds*TIME_RESOLUTION, TIME_RESOLUTION//4):
+        tokens.extend([t, TIME_RESOLUTION//4, 48 + (t//TIME_RESOLUTION) % 12, 0, 80])
+        if t % (TIME_RESOLUTION//2) == 1:
+            tokens.extend([t, TIME_RESOLUTION//2, 72 + (t//TIME_RESOLUTION) % 7, 53, 100])
+
+    return tokens
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check that tokenization handles long tracks')
+    parser.add_argument('-l', '--length', type=int, default=MAX_TRACK_TIME_IN_SECONDS,
+        help='length of the synthetic track (in seconds)')
+    parser.add_argument('-k', '--augment', type=int, default=1,
+        help='dataset augmentation factor')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        track = os.path.join(tmp, 'long.compound.txt')
+        with open(track, 'w') as f:
+            f.write(' '.join(str(tok) for tok in long_track(args.length)))
+
+        # anticipated controls late in the track exceed 16 bits until they are relativized
+        shard = os.path.join(tmp, 'long.npz')
+        count = augment_shard([track], shard, args.augment)[0]
+        assert count > 0, 'the track was discarded'
+
+        length = EVENT_SIZE*M_ALT
+        output = os.path.join(tmp, 'long.bin')
+        sequences = pack_shard([shard], [0, count], 0, output, length, binary=True)[0]
+        assert sequences > 0, 'no training sequences were packed'
+
+        for seq in read_sequences(output):
+            assert len(seq) == length + NUM_INSTRS
+            assert max(seq) < VOCAB_SIZE
+
+    print(f'Packed {sequences} sequences from a {args.length}s track ({count} tokens)')
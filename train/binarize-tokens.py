@@ -0,0 +1,22 @@
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+
+from anticipation.dataset import text_to_binary
+
+def main(args):
+    dtype = np.int32 if args.wide else np.uint16
+    for filename in args.filenames:
+        output = os.path.splitext(filename)[0] + '.bin'
+        print(f'Converting {filename} => {output}')
+        count = text_to_binary(filename, output, dtype=dtype)
+        print(f'  => Wrote {count} sequences')
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='converts tokenized text datasets to binary shards')
+    parser.add_argument('filenames', nargs='+', help='tokenized text datasets to convert')
+    parser.add_argument('-w', '--wide', action='store_true',
+            help='store tokens as int32 (default to uint16)')
+
+    main(parser.parse_args())
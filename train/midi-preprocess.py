@@ -1,42 +1,110 @@
-import traceback
+import os
+import csv
 from argparse import ArgumentParser
-from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
 from tqdm import tqdm
 
 from anticipation.convert import events_to_midi,midi_to_events, midi_to_compound, compound_to_midi
 from anticipation.config import PREPROC_WORKERS
+from anticipation.manifest import Manifest, file_hash, stage_key
+from anticipation.runner import run_isolated
 
 
 def convert_midi(filename, debug=False):
-    try:
-        tokens = midi_to_compound(filename, debug=debug)
-    except Exception:
-        if debug:
-            print('Failed to process: ', filename)
-            print(traceback.format_exc())
-
-        return 1
-
+    tokens = midi_to_compound(filename, debug=debug)
     with open(f"{filename}.compound.txt", 'w') as f:
         f.write(' '.join(str(tok) for tok in tokens))
 
-    return 0
+
+def failure_key(filename, limits):
+    """ the key of a file that the runner stopped: such a failure is only final under the same limits """
+    return stage_key('preprocess', file_hash(filename), limits)
+
+
+def convert_task(task):
+    """ convert a MIDI file unless its recorded result (entry) is up to date """
+    filename, entry, limits = task
+    key = stage_key('preprocess', file_hash(filename))
+    if entry and entry['key'] == key:
+        # errors are recorded too: no need to retry a file that hasn't changed
+        if entry['result'] != 0 or os.path.exists(f"{filename}.compound.txt"):
+            return key, entry['result'], True
+    elif entry and entry['key'] == failure_key(filename, limits):
+        return entry['key'], entry['result'], True
+
+    try:
+        convert_midi(filename)
+    except Exception as e:
+        return key, ['error', f'{type(e).__name__}: {e}'], False
+
+    return key, 0, False
 
 
 def main(args):
     filenames = glob(args.dir + '/**/*.mid', recursive=True) \
             + glob(args.dir + '/**/*.midi', recursive=True)
 
+    manifest = Manifest(os.path.join(args.dir, 'preprocess-manifest.json'))
+    name = lambda filename: os.path.relpath(filename, args.dir)
+    limits = [args.timeout, args.memory]
+    tasks = [(f, None if args.rebuild else manifest.entries.get(name(f)), limits) for f in filenames]
+
     print(f'Preprocessing {len(filenames)} files with {PREPROC_WORKERS} workers')
-    with ProcessPoolExecutor(max_workers=PREPROC_WORKERS) as executor:
-        results = list(tqdm(executor.map(convert_midi, filenames), desc='Preprocess', total=len(filenames)))
+    print(f'  time limit = {args.timeout}s per file')
+    print(f'  memory limit = {args.memory}GB per worker')
+    print(f'  workers are recycled after {args.recycle} files')
+
+    skipped = 0
+    runner = run_isolated(convert_task, tasks, PREPROC_WORKERS,
+            timeout=args.timeout, memory=int(args.memory*2**30), recycle=args.recycle)
+    for i, ((filename, _, _), status, value) in enumerate(tqdm(runner, desc='Preprocess', total=len(tasks))):
+        if status == 'ok':
+            key, result, cached = value
+            skipped += cached
+        else:
+            # the worker was stopped: record the failure so that the file is retried only if the limits change
+            key, result = failure_key(filename, limits), [status, str(value)]
+
+        manifest.put(name(filename), key, result)
+
+        # checkpoint progress so that an interrupted run can resume
+        if (i+1) % args.checkpoint == 0:
+            manifest.save()
+
+    # forget files that have been removed from the dataset
+    names = set(name(f) for f in filenames)
+    manifest.entries = {f : entry for f, entry in manifest.entries.items() if f in names}
+    manifest.save()
+
+    # report every file that failed, including failures recorded by previous runs
+    failures = [(f, *entry['result']) for f, entry in sorted(manifest.entries.items()) if entry['result'] != 0]
+    report = os.path.join(args.dir, 'preprocess-failures.csv')
+    with open(report, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'status', 'reason'])
+        writer.writerows(failures)
 
-    discards = round(100*sum(results)/float(len(filenames)),2)
-    print(f'Successfully processed {len(filenames) - sum(results)} files (discarded {discards}%)')
+    discards = round(100*len(failures)/float(len(filenames)),2)
+    print(f'Successfully processed {len(filenames) - len(failures)} files (discarded {discards}%)')
+    print(f'  => {skipped} files were up to date')
+    for status in ['error', 'timeout', 'memory', 'killed']:
+        count = sum(1 for failure in failures if failure[1] == status)
+        if count > 0:
+            print(f'  => {count} files failed ({status})')
+    print(f'  => Failures are listed in {report}')
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='prepares a MIDI dataset')
     parser.add_argument('dir', help='directory containing .mid files for training')
+    parser.add_argument('--rebuild', action='store_true',
+            help='ignore the manifest and reprocess every file')
+    parser.add_argument('--checkpoint', type=int, default=1000,
+            help='save the manifest after this many files')
+    parser.add_argument('--timeout', type=float, default=60,
+            help='wall-clock limit (in seconds) for preprocessing a file')
+    parser.add_argument('--memory', type=float, default=4,
+            help='memory limit (in GB of address space) for each worker')
+    parser.add_argument('--recycle', type=int, default=1000,
+            help='replace each worker after it has processed this many files')
     main(parser.parse_args())
@@ -1,17 +1,65 @@
 import os
+import zlib
 from argparse import ArgumentParser
-from multiprocessing import Pool, RLock
+from multiprocessing import Pool
 from glob import glob
 
+import numpy as np
 from tqdm import tqdm
 
 from anticipation.config import *
-from anticipation.tokenize import tokenize, tokenize_ia
+from anticipation.dataset import concatenate
+from anticipation.manifest import Manifest, file_hash, stage_key
+from anticipation.tokenize import M_ALT, NUM_INSTRS, augment_shard, pack_shard, shard_windows
+
+
+def chunk_files(files, size):
+    """
+    Group files into chunks of about the given size.
+
+    Chunk boundaries are determined by the file names, so adding or removing
+    a file only changes the chunk that it belongs to.
+    """
+    chunks = [[]]
+    for filename in sorted(files):
+        chunks[-1].append(filename)
+        if zlib.crc32(os.path.basename(filename).encode()) % size == 0:
+            chunks.append([])
+
+    return [chunk for chunk in chunks if chunk]
+
+
+def augment_task(task):
+    """ augment a chunk of files, unless a shard with the same content already exists """
+    split, idx, files, workdir, augment, seed, interarrival = task
+    key = stage_key('augment', augment, seed, interarrival, [file_hash(f) for f in files])
+    shard = os.path.join(workdir, f'augment-{key}.npz')
+    if os.path.exists(shard):
+        with np.load(shard) as f:
+            return split, idx, key, tuple(f['stats'].tolist()), True
+
+    # the shard is seeded by its content; write then rename, so that a shard is never partial
+    tmp = os.path.join(workdir, f'augment-{key}.tmp.npz')
+    result = augment_shard(files, tmp, augment, (int(key[:15], 16),), interarrival)
+    os.replace(tmp, shard)
+
+    return split, idx, key, result, False
+
+
+def pack_task(task):
+    split, idx, shards, offsets, output, length, seed, binary, interarrival = task
+    tmp = f'{output}.tmp'
+    result = pack_shard(shards, offsets, idx, tmp, length, seed, binary, prepare=not interarrival)
+    os.replace(tmp, output)
+
+    return split, idx, result
+
 
 def main(args):
     encoding = 'interarrival' if args.interarrival else 'arrival'
     print('Tokenizing LakhMIDI')
     print(f'  encoding type: {encoding}')
+    print(f'  output format: {"binary" if args.binary else "text"}')
     print(f'  train split: {[s for s in LAKH_SPLITS if s not in LAKH_VALID + LAKH_TEST]}')
     print(f'  validation split: {LAKH_VALID}')
     print(f'  test split: {LAKH_TEST}')
@@ -23,21 +71,112 @@ def main(args):
     print(f'  min track length = {MIN_TRACK_TIME_IN_SECONDS}s')
     print(f'  min track events = {MIN_TRACK_EVENTS}')
 
-    paths = [os.path.join(args.datadir, s) for s in LAKH_SPLITS]
-    files = [glob(f'{p}/*.compound.txt') for p in paths]
-    outputs = [os.path.join(args.datadir, f'tokenized-events-{s}.txt') for s in LAKH_SPLITS]
+    ext = 'bin' if args.binary else 'txt'
+    length = CONTEXT_SIZE if args.interarrival else EVENT_SIZE*M_ALT
+    workdir = os.path.join(args.datadir, 'shards')
+    os.makedirs(workdir, exist_ok=True)
+
+    # shards and sequences from previous runs are reused if their inputs haven't changed
+    manifest = Manifest(os.path.join(workdir, 'manifest.json'))
+    if args.rebuild:
+        manifest.entries = {}
+        for f in os.listdir(workdir):
+            os.remove(os.path.join(workdir, f))
 
     # don't augment the valid/test splits
-    augment = [1 if s in LAKH_VALID or s in LAKH_TEST else args.augment for s in LAKH_SPLITS]
+    augment = {s : 1 if s in LAKH_VALID or s in LAKH_TEST else args.augment for s in LAKH_SPLITS}
+
+    # schedule chunks of files (rather than whole splits) so that the work is balanced
+    chunks = {}
+    tasks = []
+    for i, s in enumerate(LAKH_SPLITS):
+        chunks[s] = chunk_files(glob(os.path.join(args.datadir, s, '*.compound.txt')), args.chunk)
+        for j, chunk in enumerate(chunks[s]):
+            tasks.append((s, j, chunk, workdir, augment[s], (args.seed, i), args.interarrival))
+
+    # largest chunks first; idle workers pick up the next chunk as they finish
+    tasks.sort(key=lambda task: -sum(os.path.getsize(f) for f in task[2]))
 
-    # parallel tokenization drops the last chunk of < M tokens
-    # if concerned about waste: process larger groups of datafiles
-    func = tokenize_ia if args.interarrival else tokenize
-    with Pool(processes=PREPROC_WORKERS, initargs=(RLock(),), initializer=tqdm.set_lock) as pool:
-        results = pool.starmap(func, zip(files, outputs, augment, range(len(LAKH_SPLITS))))
+    current = set() # outputs of this run
+    with Pool(processes=PREPROC_WORKERS) as pool:
+        keys = {s : [None]*len(chunks[s]) for s in LAKH_SPLITS}
+        tokens = {s : [0]*len(chunks[s]) for s in LAKH_SPLITS}
+        results = []
+        cached = 0
+        for s, j, key, result, done in tqdm(pool.imap_unordered(augment_task, tasks), desc='Augment', total=len(tasks)):
+            cached += done
+            keys[s][j] = key
+            tokens[s][j] = result[0]
+            results.append(result[1:])
 
-    seq_count, rest_count, too_short, too_long, too_manyinstr, discarded_seqs, too_fewnotes, starts_late, ends_early, truncations \
-            = (sum(x) for x in zip(*results))
+            manifest.put(f'augment-{key}.npz', key, result)
+            current.add(f'augment-{key}.npz')
+
+        manifest.save()
+        print(f'Augmented {len(tasks)} chunks ({cached} were up to date)')
+
+        # each chunk packs the sequences that begin within it
+        tasks = []
+        packed = []
+        parts = {}
+        pending = {} # output -> key of the sequences being packed
+        for i, s in enumerate(LAKH_SPLITS):
+            shards = [os.path.join(workdir, f'augment-{key}.npz') for key in keys[s]]
+            offsets = [0]
+            for count in tokens[s]:
+                offsets.append(offsets[-1] + count)
+
+            parts[s] = []
+            for j in range(len(chunks[s])):
+                first, last, end = shard_windows(offsets, j, length)
+                inputs = [(offsets[k], keys[s][k]) for k in range(j, end)]
+                key = stage_key('pack', length, NUM_INSTRS, args.binary, args.interarrival,
+                                (args.seed, i), first, last, inputs)
+                output = f'pack-{key}.{ext}'
+                parts[s].append(os.path.join(workdir, output))
+                current.add(output)
+
+                result = manifest.get(output, key)
+                if result is not None and os.path.exists(os.path.join(workdir, output)):
+                    packed.append(result)
+                    continue
+
+                pending[output] = key
+                tasks.append((s, j, shards, offsets, os.path.join(workdir, output), length,
+                              (args.seed, i), args.binary, args.interarrival))
+
+        print(f'Packing {len(tasks)+len(packed)} chunks ({len(packed)} are up to date)')
+        for i, (s, j, result) in enumerate(tqdm(pool.imap_unordered(pack_task, tasks), desc='Pack', total=len(tasks))):
+            output = os.path.basename(parts[s][j])
+            manifest.put(output, pending[output], result)
+            packed.append(result)
+
+            # checkpoint progress so that an interrupted run resumes from the completed shards
+            if (i+1) % args.checkpoint == 0:
+                manifest.save()
+
+        manifest.save()
+
+    # deterministic merge: concatenate each split's chunks in order
+    for s in LAKH_SPLITS:
+        output = f'tokenized-events-{s}.{ext}'
+        key = stage_key('pack', [os.path.basename(part) for part in parts[s]])
+        if manifest.get(output, key) is None or not os.path.exists(os.path.join(args.datadir, output)):
+            concatenate(parts[s], os.path.join(args.datadir, output), args.binary)
+            manifest.put(output, key, len(parts[s]))
+
+        current.add(output)
+
+    # forget (and remove) shards that are no longer part of the build
+    for f in os.listdir(workdir):
+        if f not in current and f != 'manifest.json':
+            os.remove(os.path.join(workdir, f))
+
+    manifest.entries = {output : entry for output, entry in manifest.entries.items() if output in current}
+    manifest.save()
+
+    rest_count, too_short, too_long, too_manyinstr, truncations = (sum(x) for x in zip(*results))
+    seq_count, discarded_seqs, too_fewnotes, starts_late, ends_early = (sum(x) for x in zip(*packed))
     rest_ratio = round(100*float(rest_count)/(seq_count*M),2)
 
     trunc_type = 'interarrival' if args.interarrival else 'duration'
@@ -67,5 +206,16 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--interarrival',
             action='store_true',
             help='request interarrival-time enocoding (default to arrival-time encoding)')
+    parser.add_argument('-b', '--binary',
+            action='store_true',
+            help='write binary shards (default to text, one sequence per line)')
+    parser.add_argument('-c', '--chunk', type=int, default=16,
+            help='average number of files per unit of work')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='random seed for augmentation')
+    parser.add_argument('--rebuild', action='store_true',
+            help='ignore the results of previous runs')
+    parser.add_argument('--checkpoint', type=int, default=100,
+            help='save the manifest after packing this many chunks')
 
     main(parser.parse_args())